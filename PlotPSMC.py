@@ -1,192 +1,2051 @@
-import matplotlib.pyplot as pplot
-import matplotlib.ticker as mtick
 import re as regex
 from random import random as rnd
-import numpy
+import importlib
+import sys
 import os
+import io
+import mmap
+import gzip
+import zlib
+import collections
+import itertools
+import hashlib
+import tempfile
+import time
+import json
+import struct
+import pickle
+import contextlib
+import concurrent.futures
+import glob
 
 
-class OOMFormatter(mtick.ScalarFormatter):
-    # https://stackoverflow.com/questions/42656139/set-scientific-notation-with-fixed-exponent-and-significant-digits-for-multiple
+class _LazyModule:
+    # Stands in for a module that is only imported when one of its attributes is first used,
+    # numpy and matplotlib are slow to import and are not needed until something is parsed or plotted
 
-    def __init__(self, order=0, fformat="%1.1f", offset=True, mathText=True):
-        self.oom = order
-        self.fformat = fformat
-        mtick.ScalarFormatter.__init__(self, useOffset=offset, useMathText=mathText)
+    def __init__(self, moduleName):
+        self._moduleName = moduleName
 
-    def _set_orderOfMagnitude(self, nothing):
-        self.orderOfMagnitude = self.oom
+    def __getattr__(self, attributeName):
+        module = importlib.import_module(self._moduleName)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attributeName)
 
-    def _set_format(self, vmin, vmax):
-        self.format = self.fformat
-        if self._useMathText:
-            self.format = '$%s$' % mtick._mathdefault(self.format)
 
+numpy = _LazyModule("numpy")
+mtick = _LazyModule("matplotlib.ticker")
+mfigure = _LazyModule("matplotlib.figure")
+mcollections = _LazyModule("matplotlib.collections")
+mcolors = _LazyModule("matplotlib.colors")
+mcm = _LazyModule("matplotlib.cm")
+backend_agg = _LazyModule("matplotlib.backends.backend_agg")
 
-def parse_psmc_output(psmcInputList, representAsEffectiveSize):
+if sys.platform.startswith("linux") and not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")):
+    # headless, in case pyplot gets imported by whoever uses this module
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+_OOMFormatter = None
+
+
+def _oom_formatter_class():
+    # OOMFormatter subclasses a matplotlib class, so it is only defined once it is first used
+    global _OOMFormatter
+    if _OOMFormatter is not None:
+        return _OOMFormatter
+
+    class OOMFormatter(mtick.ScalarFormatter):
+        # https://stackoverflow.com/questions/42656139/set-scientific-notation-with-fixed-exponent-and-significant-digits-for-multiple
+
+        def __init__(self, order=0, fformat="%1.1f", offset=True, mathText=True):
+            self.oom = order
+            self.fformat = fformat
+            mtick.ScalarFormatter.__init__(self, useOffset=offset, useMathText=mathText)
+
+        def _set_orderOfMagnitude(self, nothing):
+            self.orderOfMagnitude = self.oom
+
+        def _set_format(self, vmin=None, vmax=None):  # matplotlib >= 3.1 no longer passes vmin/vmax
+            self.format = self.fformat
+            if self._useMathText:
+                self.format = r'$\mathdefault{%s}$' % self.format
+
+        def __reduce__(self):
+            # the class is not a module attribute that pickle could find, so it is rebuilt by _new_oom_formatter
+            # when a figure is unpickled (e.g. by the processes of export_psmc_figure)
+            return _new_oom_formatter, (self.oom, self.fformat), self.__dict__.copy()
+
+    _OOMFormatter = OOMFormatter
+    return _OOMFormatter
+
+
+def _new_oom_formatter(order, fformat):
+    return _oom_formatter_class()(order, fformat)
+
+
+def __getattr__(attributeName):
+    # PlotPSMC.OOMFormatter for code written against the eagerly defined class (python >= 3.7 only, PEP 562),
+    # nothing in this module depends on it
+    if attributeName == "OOMFormatter":
+        return _oom_formatter_class()
+    raise AttributeError("module %r has no attribute %r" % (__name__, attributeName))
+
+
+class PlotReport:
+    # Where the time of a plot went. parse_psmc_output, PsmcFigure and plotPsmc add one entry to .stages per
+    # file and stage when they are given a report: a dict with the stage name, the file (or sample) it is
+    # about, its duration in seconds and the counts that make sense for it (bytes, replicates, artists).
+    # Files parsed in a pool are timed in their worker, so their stages overlap in wall-clock time.
+
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def timed(self, stageName, subject=None, **stageCounts):
+        # the yielded entry can be given more counts while the stage runs
+        stageEntry = dict(stage=stageName, subject=subject, **stageCounts)
+        startTime = time.perf_counter()
+        try:
+            yield stageEntry
+        finally:
+            stageEntry["seconds"] = time.perf_counter() - startTime
+            self.stages.append(stageEntry)
+
+    def totals(self):
+        # seconds per stage name, in the order the stages first ran
+        stageTotals = {}
+        for stageEntry in self.stages:
+            stageTotals[stageEntry["stage"]] = stageTotals.get(stageEntry["stage"], 0) + stageEntry["seconds"]
+        return stageTotals
+
+    def __str__(self):
+        reportLines = []
+        for stageEntry in self.stages:
+            stageCounts = ", ".join("%s: %s" % (countName, countValue) for countName, countValue in stageEntry.items()
+                                    if countName not in ("stage", "subject", "seconds"))
+            reportLines.append("%-9s %8.1f ms  %s%s" % (stageEntry["stage"], stageEntry["seconds"] * 1e3,
+                                                       os.path.basename(str(stageEntry["subject"] or "")),
+                                                       " (%s)" % stageCounts if stageCounts else ""))
+        reportLines.append(self.format_totals())
+        return "\n".join(reportLines)
+
+    def format_totals(self):
+        return "total: " + ", ".join("%s %.1f ms" % (stageName, seconds * 1e3)
+                                     for stageName, seconds in self.totals().items())
+
+
+def _scale_psmc_points(timePoints, lambdaPoints, estimatedTheta, psmcFiles, representAsEffectiveSize):
+    # Works on single replicates as well as on (replicates x intervals) arrays,
+    # in which case estimatedTheta is a (replicates x 1) column that broadcasts over the intervals
+
+    generationTime = psmcFiles[1]
+    mutRate = psmcFiles[2]
+    binSize = psmcFiles[3]
+    timePoints = numpy.asarray(timePoints, dtype=numpy.float64)
+    lambdaPoints = numpy.asarray(lambdaPoints, dtype=numpy.float64)
+    n0 = estimatedTheta/(4*mutRate)/binSize
+
+    if representAsEffectiveSize:
+        scaledTime = (generationTime * 2) * n0 * timePoints
+        scaledSize = n0 * lambdaPoints
+    else:
+        scaledTime = timePoints * (estimatedTheta / binSize)
+        # pairwiseSequenceDivergence
+        scaledSize = lambdaPoints * (estimatedTheta / binSize * 1e3)
+        # scaledMutRate
+
+    return scaledTime, scaledSize
+
+
+def _scan_last_iterations(pathToPsmcFile):
+    # Reads the whole file line by line and keeps the last RD round of every replicate
+
+    lastIteration = ""
+    with io.TextIOWrapper(_open_psmc_file(pathToPsmcFile)) as psmcFile:
+        inBlock = False
+        timePoints, lambdaPoints = [], []
+
+        for line in psmcFile:
+            if not line.endswith("\n"):
+                break  # the last line is still being written
+            tokens = line.split()
+            if not tokens:
+                continue
+            if tokens[0] == "MM" and tokens[1].split(":")[0] == "n_iterations":
+                # We could also iterate through the whole file and get the maximum RD value
+                lastIteration = tokens[1].split(":")[1].strip(",")
+            if tokens == ['RD', lastIteration]:  # Last iteration
+                inBlock = True
+                timePoints, lambdaPoints = [], []
+            if inBlock and tokens[0] == "RS":
+                timePoints.append(float(tokens[2]))
+                lambdaPoints.append(float(tokens[3]))
+            elif inBlock and tokens[0] == "PA":
+                inBlock = False
+                yield float(tokens[2]), timePoints, lambdaPoints
+
+
+_ITERATIONS_HEADER = regex.compile(rb"n_iterations:(\d+)")
+
+
+def _next_iterations_header(psmcBuffer, searchFrom=0):
+    # _ITERATIONS_HEADER.search, with the text located by find, which is much faster on large buffers
+    headerStart = psmcBuffer.find(b"n_iterations:", searchFrom)
+    while headerStart >= 0:
+        header = _ITERATIONS_HEADER.match(psmcBuffer, headerStart)
+        if header:
+            return header
+        headerStart = psmcBuffer.find(b"n_iterations:", headerStart + 1)
+    return None
+
+
+def _find_last_iteration_blocks(psmcBuffer):
+    # Yields the (start, end) byte offsets of the last RD round of every replicate in psmcBuffer.
+    # Instead of reading every round, the size of round 0 is used to guess where round n_iterations starts
+    # (all rounds of a replicate have the same lines), and only a window around that guess is searched.
+    # Every search stops at the n_iterations header of the next replicate, so that a replicate cut short (e.g. a
+    # killed bootstrap run) is skipped on its own instead of being matched with the rounds of a later one.
+
+    bufferSize = len(psmcBuffer)
+    header = _next_iterations_header(psmcBuffer)
+    while header:
+        nIterations = int(header.group(1))
+        nextHeader = _next_iterations_header(psmcBuffer, header.end())
+        replicateEnd = nextHeader.start() if nextHeader else bufferSize
+        lastRound = b"\nRD\t%d\n" % nIterations
+        firstRound = psmcBuffer.find(b"\nRD\t0\n", header.end(), replicateEnd)
+        if firstRound < 0:
+            header = nextHeader
+            continue
+        secondRound = psmcBuffer.find(b"\nRD\t1\n", firstRound, replicateEnd)
+        roundSize = secondRound - firstRound if secondRound > firstRound else replicateEnd - firstRound
+
+        guess = firstRound + nIterations * roundSize
+        window = roundSize
+        while True:
+            windowStart = max(firstRound, min(guess - window, replicateEnd))
+            windowEnd = min(replicateEnd, guess + window + len(lastRound))
+            roundStart = psmcBuffer.find(lastRound, windowStart, windowEnd)
+            if roundStart >= 0 or (windowStart == firstRound and windowEnd == replicateEnd):
+                break
+            window *= 2
+
+        paStart = psmcBuffer.find(b"\nPA\t", roundStart, replicateEnd) if roundStart >= 0 else -1
+        if paStart < 0 or psmcBuffer.find(b"\nRD\t", roundStart + 1, paStart) >= 0:
+            # last round missing or cut short, skip this replicate
+            header = nextHeader
+            continue
+        paEnd = psmcBuffer.find(b"\n", paStart + 1, replicateEnd)
+        if paEnd < 0:
+            # the PA line is still being written (or the run was killed while writing it)
+            header = nextHeader
+            continue
+
+        yield roundStart + 1, paEnd
+        header = nextHeader
+
+
+def _stack_iterations(estimatedThetas, timePoints, lambdaPoints):
+    # Replicates of a file normally share the same time intervals and are kept as (replicates x intervals)
+    # arrays, otherwise they stay as a list of one array per replicate
+
+    estimatedThetas = numpy.array(estimatedThetas, dtype=numpy.float64)
+    if len({len(replicateTimes) for replicateTimes in timePoints}) == 1:
+        return estimatedThetas, numpy.vstack(timePoints), numpy.vstack(lambdaPoints)
+    if not timePoints:
+        return estimatedThetas, numpy.empty((0, 0)), numpy.empty((0, 0))
+    return (estimatedThetas,
+            [numpy.asarray(replicateTimes, dtype=numpy.float64) for replicateTimes in timePoints],
+            [numpy.asarray(replicateLambdas, dtype=numpy.float64) for replicateLambdas in lambdaPoints])
+
+
+def _read_iteration_blocks(iterationBlocks):
+    # Parses the RS and PA lines of RD rounds. The RS tables of all rounds are joined
+    # and converted to a float64 array with a single numpy call.
+
+    rsTables, estimatedThetas, nIntervals = [], [], []
+    for iterationBlock in iterationBlocks:
+        rsStart = iterationBlock.find(b"RS\t")
+        paStart = iterationBlock.find(b"\nPA\t", rsStart)
+        rsTables.append(iterationBlock[rsStart:paStart + 1])
+        nIntervals.append(rsTables[-1].count(b"\n"))
+        estimatedThetas.append(float(iterationBlock[paStart + 1:].split(None, 3)[2]))
+
+    if not rsTables:
+        return _stack_iterations([], [], [])
+
+    # RS  k  t_k  lambda_k  pi_k ...
+    rsTable = numpy.loadtxt(io.BytesIO(b"".join(rsTables)), dtype=numpy.float64, usecols=(2, 3), ndmin=2)
+
+    if len(set(nIntervals)) == 1:
+        rsTable = rsTable.reshape(len(rsTables), nIntervals[0], 2)
+        return (numpy.array(estimatedThetas),
+                numpy.ascontiguousarray(rsTable[:, :, 0]),
+                numpy.ascontiguousarray(rsTable[:, :, 1]))
+
+    replicateTables = numpy.split(rsTable, numpy.cumsum(nIntervals)[:-1])
+    return _stack_iterations(estimatedThetas,
+                             [replicateTable[:, 0] for replicateTable in replicateTables],
+                             [replicateTable[:, 1] for replicateTable in replicateTables])
+
+
+def _seek_last_iterations(pathToPsmcFile, report=None):
+    # Same output as _scan_last_iterations, but only the last round of each replicate is read and parsed
+
+    report = report or PlotReport()
+    if psmc_compression(pathToPsmcFile):
+        return _stream_last_iterations(pathToPsmcFile, report)
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        fileSize = os.fstat(psmcFile.fileno()).st_size
+        if fileSize == 0:
+            return _stack_iterations([], [], [])
+        with mmap.mmap(psmcFile.fileno(), 0, access=mmap.ACCESS_READ) as psmcBuffer:
+            # the pages of the mapping are only read from disk while the blocks are located and copied
+            with report.timed("read", pathToPsmcFile, bytes=fileSize) as readStage:
+                iterationBlocks = [psmcBuffer[blockStart:blockEnd] for blockStart, blockEnd
+                                   in _find_last_iteration_blocks(psmcBuffer)]
+                readStage["replicates"] = len(iterationBlocks)
+    with report.timed("tokenize", pathToPsmcFile, bytes=sum(map(len, iterationBlocks))):
+        return _read_iteration_blocks(iterationBlocks)
+
+
+# psmc files can also be read compressed with gzip, bgzip (.gz or .bgz: gzip made of independent blocks of at most
+# 64 KiB, as written by bgzip from htslib) or zstd (.zst, needs the zstandard package). They are recognised by
+# their first bytes and decompressed while they are read, and only one replicate of decompressed text is kept
+# in memory at a time. The blocks of bgzip files are decompressed by bgzipThreads threads (zlib releases the GIL).
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_BGZF_BATCH_BLOCKS = 16  # blocks decompressed by one thread at a time, at most 1 MiB of text
+bgzipThreads = os.cpu_count() or 1
+
+
+def psmc_compression(pathToPsmcFile):
+    # "gzip", "bgzip", "zstd" or None for a psmc file, from its first bytes
+
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        fileStart = psmcFile.read(14)
+    if fileStart.startswith(_GZIP_MAGIC):
+        # FEXTRA flag set and a "BC" subfield first in the extra field, that holds the size of the block
+        return "bgzip" if len(fileStart) == 14 and fileStart[3] & 4 and fileStart[12:14] == b"BC" else "gzip"
+    if fileStart.startswith(_ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def _read_bgzf_blocks(psmcFile):
+    # Yields the deflate data, CRC32 and size of every block of a bgzip file
+
+    while True:
+        blockOffset = psmcFile.tell()
+        blockHeader = psmcFile.read(12)
+        if not blockHeader:
+            return
+        if len(blockHeader) < 12 or not blockHeader.startswith(_GZIP_MAGIC) or not blockHeader[3] & 4:
+            raise ValueError("%s is not a bgzip block at offset %d" % (psmcFile.name, blockOffset))
+        extraLength, = struct.unpack("<H", blockHeader[10:12])
+        extraFields = psmcFile.read(extraLength)
+
+        blockSize, fieldStart = None, 0
+        while fieldStart + 4 <= len(extraFields):
+            fieldLength, = struct.unpack("<H", extraFields[fieldStart + 2:fieldStart + 4])
+            if extraFields[fieldStart:fieldStart + 2] == b"BC" and fieldLength == 2:
+                blockSize, = struct.unpack("<H", extraFields[fieldStart + 4:fieldStart + 6])
+            fieldStart += 4 + fieldLength
+        if blockSize is None:
+            raise ValueError("%s has a gzip block without bgzip size at offset %d" % (psmcFile.name, blockOffset))
+        yield psmcFile.read(blockSize + 1 - 12 - extraLength)
+
+
+def _inflate_bgzf_blocks(blockBodies):
+
+    blockTexts = []
+    for blockBody in blockBodies:
+        blockText = zlib.decompress(blockBody[:-8], -zlib.MAX_WBITS)
+        if struct.unpack("<II", blockBody[-8:]) != (zlib.crc32(blockText), len(blockText)):
+            raise ValueError("corrupt bgzip block, its CRC32 or size does not match")
+        blockTexts.append(blockText)
+    return b"".join(blockTexts)
+
+
+def _iter_bgzf_text(pathToPsmcFile, nThreads):
+    # The decompressed text of a bgzip file, in order, in chunks of _BGZF_BATCH_BLOCKS blocks. Up to two
+    # chunks per thread are decompressed ahead of the one being read.
+
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        blockBodies = _read_bgzf_blocks(psmcFile)
+        blockBatches = iter(lambda: list(itertools.islice(blockBodies, _BGZF_BATCH_BLOCKS)), [])
+        if nThreads <= 1:
+            for blockBatch in blockBatches:
+                yield _inflate_bgzf_blocks(blockBatch)
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as inflatePool:
+            inflateJobs = collections.deque()
+            for blockBatch in blockBatches:
+                inflateJobs.append(inflatePool.submit(_inflate_bgzf_blocks, blockBatch))
+                if len(inflateJobs) > 2 * nThreads:
+                    yield inflateJobs.popleft().result()
+            while inflateJobs:
+                yield inflateJobs.popleft().result()
+
+
+class _ChunkReader(io.RawIOBase):
+    # A read-only stream over an iterator of bytes, e.g. _iter_bgzf_text, closing the iterator when closed
+
+    def __init__(self, textChunks):
+        self._textChunks = textChunks
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, readBuffer):
+        while not len(self._chunk):
+            try:
+                self._chunk = memoryview(next(self._textChunks))
+            except StopIteration:
+                return 0
+        nBytes = min(len(readBuffer), len(self._chunk))
+        readBuffer[:nBytes] = self._chunk[:nBytes]
+        self._chunk = self._chunk[nBytes:]
+        return nBytes
+
+    def close(self):
+        self._textChunks.close()
+        super().close()
+
+
+def _open_zstd_file(pathToPsmcFile):
+
+    try:
+        import zstandard
+    except ImportError:
+        try:
+            from compression import zstd  # Python 3.14
+        except ImportError:
+            raise ImportError("reading the zstd-compressed %s needs the zstandard package "
+                              "(pip install zstandard)" % pathToPsmcFile) from None
+        return zstd.open(pathToPsmcFile, 'rb')
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(pathToPsmcFile, 'rb'), closefd=True),
+                             1 << 20)
+
+
+def _open_psmc_file(pathToPsmcFile):
+    # A binary file object with the (decompressed) text of a psmc file
+
+    compression = psmc_compression(pathToPsmcFile)
+    if compression == "bgzip":
+        return io.BufferedReader(_ChunkReader(_iter_bgzf_text(pathToPsmcFile, bgzipThreads)), 1 << 20)
+    if compression == "gzip":
+        return gzip.open(pathToPsmcFile, 'rb')
+    if compression == "zstd":
+        return _open_zstd_file(pathToPsmcFile)
+    return open(pathToPsmcFile, 'rb')
+
+
+def _iter_stream_iteration_blocks(psmcStream, chunkSize=1 << 20):
+    # _find_last_iteration_blocks for a stream: the text is cut before every n_iterations header, where a
+    # replicate starts, and every replicate is searched on its own once it has been read completely
+
+    pendingText = bytearray()
+    searchFrom = 0  # where the header of the next replicate is looked for in pendingText
+    while True:
+        textChunk = psmcStream.read(chunkSize)
+        pendingText += textChunk
+        while True:
+            header = _ITERATIONS_HEADER.search(pendingText, searchFrom)
+            # a header at the very end may still be missing digits
+            if header is None or (textChunk and header.end() == len(pendingText)):
+                break
+            replicateText = bytes(pendingText[:header.start()])
+            for blockStart, blockEnd in _find_last_iteration_blocks(replicateText):
+                yield replicateText[blockStart:blockEnd]
+            del pendingText[:header.start()]
+            searchFrom = header.end() - header.start()
+        if not textChunk:
+            replicateText = bytes(pendingText)
+            for blockStart, blockEnd in _find_last_iteration_blocks(replicateText):
+                yield replicateText[blockStart:blockEnd]
+            return
+        searchFrom = max(searchFrom, len(pendingText) - 64)
+
+
+def _stream_last_iterations(pathToPsmcFile, report=None):
+    # _seek_last_iterations for a compressed file, decompressed and searched one replicate at a time
+
+    report = report or PlotReport()
+    with report.timed("read", pathToPsmcFile, bytes=os.path.getsize(pathToPsmcFile)) as readStage:
+        with _open_psmc_file(pathToPsmcFile) as psmcStream:
+            iterationBlocks = list(_iter_stream_iteration_blocks(psmcStream))
+        readStage["replicates"] = len(iterationBlocks)
+    with report.timed("tokenize", pathToPsmcFile, bytes=sum(map(len, iterationBlocks))):
+        return _read_iteration_blocks(iterationBlocks)
+
+
+# Parsed psmc files can be cached on disk as one .npy file per input, the least recently used entries are
+# evicted once the cache grows past parseCacheMaxBytes. The cache is off unless parseCacheDirectory (or the
+# PLOTPSMC_CACHE_DIR environment variable) points to a directory: every lookup hashes the whole input, which
+# only pays off for inputs that are re-plotted often, or within one process where the hash is remembered.
+parseCacheDirectory = os.environ.get("PLOTPSMC_CACHE_DIR") or None
+parseCacheMaxBytes = int(os.environ.get("PLOTPSMC_CACHE_MAX_BYTES", 256 * 2**20))
+_PARSE_CACHE_VERSION = 1
+_contentDigests = {}
+
+
+def _parse_cache_path(pathToPsmcFile):
+    # The key covers path, size, mtime and content, so an entry can never be used for a file that changed.
+    # Content digests are remembered for as long as the file stat does not change.
+
+    pathToPsmcFile = os.path.abspath(pathToPsmcFile)
+    fileStat = os.stat(pathToPsmcFile)
+    fileFingerprint = (pathToPsmcFile, fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino)
+
+    contentDigest = _contentDigests.get(fileFingerprint)
+    if contentDigest is None:
+        contentHash = hashlib.sha256()
+        with open(pathToPsmcFile, 'rb') as psmcFile:
+            for chunk in iter(lambda: psmcFile.read(1 << 20), b""):
+                contentHash.update(chunk)
+        contentDigest = _contentDigests[fileFingerprint] = contentHash.hexdigest()
+
+    cacheKey = hashlib.sha256("{}|{}|{}|{}|{}".format(
+        _PARSE_CACHE_VERSION, pathToPsmcFile, fileStat.st_size, fileStat.st_mtime_ns, contentDigest).encode())
+    return os.path.join(parseCacheDirectory, cacheKey.hexdigest()[:40] + ".npy")
+
+
+def _read_parse_cache(cachePath):
+    # an entry is a single (replicates x 1+2*intervals) array: theta, then the t_k and then the lambda_k columns
+
+    try:
+        cachedData = numpy.load(cachePath, allow_pickle=False)
+        os.utime(cachePath)  # mark as recently used
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # unreadable entry, drop it
+        try:
+            os.remove(cachePath)
+        except OSError:
+            pass
+        return None
+
+    nIntervals = (cachedData.shape[1] - 1) // 2
+    return (numpy.ascontiguousarray(cachedData[:, 0]),
+            numpy.ascontiguousarray(cachedData[:, 1:nIntervals + 1]),
+            numpy.ascontiguousarray(cachedData[:, nIntervals + 1:]))
+
+
+def _write_parse_cache(cachePath, lastIterations):
+
+    estimatedThetas, timePoints, lambdaPoints = lastIterations
+    try:
+        os.makedirs(parseCacheDirectory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=parseCacheDirectory, suffix=".tmp", delete=False) as cacheFile:
+            numpy.save(cacheFile, numpy.hstack((estimatedThetas[:, None], timePoints, lambdaPoints)))
+        os.replace(cacheFile.name, cachePath)
+        _evict_parse_cache()
+    except OSError:
+        pass  # the cache is only an optimization, e.g. a read-only home directory
+
+
+def _evict_parse_cache():
+
+    cacheEntries = []
+    for entry in os.scandir(parseCacheDirectory):
+        if entry.name.endswith(".npy"):
+            entryStat = entry.stat()
+            cacheEntries.append((entryStat.st_mtime, entryStat.st_size, entry.path))
+
+    cacheSize = sum(entrySize for _, entrySize, _ in cacheEntries)
+    for _, entrySize, entryPath in sorted(cacheEntries):
+        if cacheSize <= parseCacheMaxBytes:
+            break
+        try:
+            os.remove(entryPath)
+        except OSError:
+            pass
+        cacheSize -= entrySize
+
+
+# A psmc file can be converted once (convert_psmc_to_archive) into a binary archive that is read in place of
+# the text file. The archive holds every complete round of every replicate: the LK/QD/RI/TR/MT/PA values of
+# the round and its RS t_k, lambda_k and pi_k columns as float64 arrays, indexed by replicate and round, plus
+# the last round of each replicate laid out the way the parser returns it. Reading it is a memory mapping.
+# Layout (also used by the round index): magic, little-endian uint64 offset of the data, JSON header describing
+# the arrays, then the arrays themselves, each starting on a _ARCHIVE_ALIGNMENT byte boundary.
+_ARCHIVE_MAGIC = b"PSMCARC1"
+_ARCHIVE_ALIGNMENT = 64
+_ARCHIVE_ROUND_COLUMNS = ("LK", "QD_before", "QD_after", "RI", "TR_theta", "TR_rho", "MT",
+                          "PA_theta", "PA_rho", "PA_max_t")
+
+
+def _aligned(nBytes):
+    return -(-nBytes // _ARCHIVE_ALIGNMENT) * _ARCHIVE_ALIGNMENT
+
+
+def _read_psmc_rounds(psmcFile):
+    # One pass over a text psmc file, returns the n_iterations of every replicate, the replicate, RD number
+    # and values of every complete round (rounds without a whole PA line, e.g. at the end of a file that psmc is
+    # still writing or of a killed run, are dropped) and the RS lines of those rounds, with the offset of each
+    # round's first line
+
+    replicateIterations = []
+    roundReplicates, roundIterations, roundValues, rsOffsets = [], [], [], [0]
+    rsLines = []
+    roundValue = None  # values of the round being read
+    for line in psmcFile:
+        if line[-1:] != b"\n":
+            break  # the last line is still being written
+        lineTag = line[:3]
+        if lineTag == b"RS\t":
+            if roundValue is not None:
+                rsLines.append(line)
+            continue
+        if lineTag == b"RD\t" or (lineTag == b"MM\t" and b"n_iterations:" in line):
+            del rsLines[rsOffsets[-1]:]  # an unfinished round
+            roundValue = None
+            if lineTag == b"MM\t":
+                replicateIterations.append(int(_ITERATIONS_HEADER.search(line).group(1)))
+            elif replicateIterations:
+                roundIteration = int(line[3:])
+                roundValue = [numpy.nan] * len(_ARCHIVE_ROUND_COLUMNS)
+            continue
+        if roundValue is None:
+            continue
+
+        tokens = line.split()
+        if lineTag == b"LK\t":
+            roundValue[0] = float(tokens[1])
+        elif lineTag == b"QD\t":
+            roundValue[1:3] = float(tokens[1]), float(tokens[3])
+        elif lineTag == b"RI\t":
+            roundValue[3] = float(tokens[1])
+        elif lineTag == b"TR\t":
+            roundValue[4:6] = float(tokens[1]), float(tokens[2])
+        elif lineTag == b"MT\t":
+            roundValue[6] = float(tokens[1])
+        elif lineTag == b"PA\t":
+            # PA  pattern  theta  rho  max_t  lambdas...
+            roundValue[7:10] = float(tokens[2]), float(tokens[3]), float(tokens[4])
+            roundReplicates.append(len(replicateIterations) - 1)
+            roundIterations.append(roundIteration)
+            roundValues.append(roundValue)
+            rsOffsets.append(len(rsLines))
+            roundValue = None
+    del rsLines[rsOffsets[-1]:]
+
+    return replicateIterations, roundReplicates, roundIterations, roundValues, rsOffsets, rsLines
+
+
+def _tabulate_psmc_rounds(pathToPsmcFile):
+    # every complete round of a text psmc file as the round arrays of an archive
+
+    with _open_psmc_file(pathToPsmcFile) as psmcFile:
+        replicateIterations, roundReplicates, roundIterations, roundValues, rsOffsets, rsLines = \
+            _read_psmc_rounds(psmcFile)
+
+    # RS  k  t_k  lambda_k  pi_k ...
+    rsTable = numpy.loadtxt(io.BytesIO(b"".join(rsLines)), dtype=numpy.float64, usecols=(2, 3, 4), ndmin=2) \
+        if rsLines else numpy.empty((0, 3))
+    return dict(replicateIterations=numpy.array(replicateIterations, dtype=numpy.int64),
+                roundReplicates=numpy.array(roundReplicates, dtype=numpy.int64),
+                roundIterations=numpy.array(roundIterations, dtype=numpy.int64),
+                roundValues=numpy.array(roundValues, dtype=numpy.float64).reshape(-1, len(_ARCHIVE_ROUND_COLUMNS)),
+                rsOffsets=numpy.array(rsOffsets, dtype=numpy.int64),
+                rsTimes=rsTable[:, 0],
+                rsLambdas=rsTable[:, 1],
+                rsPis=rsTable[:, 2])
+
+
+def _psmc_file_stem(pathToPsmcFile):
+    # the path without its extension, nor that of its compression (sample.psmc.gz -> sample)
+    pathStem, extension = os.path.splitext(pathToPsmcFile)
+    if extension in (".gz", ".bgz", ".zst"):
+        pathStem = os.path.splitext(pathStem)[0]
+    return pathStem
+
+
+def convert_psmc_to_archive(pathToPsmcFile, pathToArchive=None):
+    # Writes the binary archive of a (possibly compressed) text psmc file, by default next to it with a .psmcarc
+    # extension, and returns its path. parse_psmc_output and iter_psmc_replicates accept the archive as a psmc file.
+    if pathToArchive is None:
+        pathToArchive = _psmc_file_stem(pathToPsmcFile) + ".psmcarc"
+
+    archiveArrays = _tabulate_psmc_rounds(pathToPsmcFile)
+    replicateIterations = archiveArrays["replicateIterations"]
+    roundReplicates, roundIterations = archiveArrays["roundReplicates"], archiveArrays["roundIterations"]
+    roundValues, rsOffsets = archiveArrays["roundValues"], archiveArrays["rsOffsets"]
+
+    # the first round numbered n_iterations of each replicate, as _find_last_iteration_blocks finds it
+    lastRounds = []
+    for i_replicate, nIterations in enumerate(replicateIterations):
+        replicateLastRounds = numpy.flatnonzero((roundReplicates == i_replicate) & (roundIterations == nIterations))
+        lastRounds += replicateLastRounds[:1].tolist()
+    lastRounds = numpy.array(lastRounds, dtype=numpy.int64)
+    lastRows = [numpy.arange(rsOffsets[i_round], rsOffsets[i_round + 1]) for i_round in lastRounds]
+    lastRows = numpy.concatenate(lastRows) if lastRows else numpy.empty(0, dtype=numpy.int64)
+
+    archiveArrays.update(
+        lastRounds=lastRounds,
+        lastThetas=roundValues[lastRounds, _ARCHIVE_ROUND_COLUMNS.index("PA_theta")],
+        lastOffsets=numpy.concatenate(([0], numpy.cumsum(rsOffsets[lastRounds + 1] - rsOffsets[lastRounds]))),
+        lastTimes=archiveArrays["rsTimes"][lastRows],
+        lastLambdas=archiveArrays["rsLambdas"][lastRows])
+
+    _write_array_file(pathToArchive, _ARCHIVE_MAGIC, dict(roundColumns=_ARCHIVE_ROUND_COLUMNS), archiveArrays)
+    return pathToArchive
+
+
+def _write_array_file(pathToFile, fileMagic, fileHeader, fileArrays):
+    # the archive layout: fileHeader is stored in the JSON header, next to the description of the arrays
+
+    fileHeader = dict(fileHeader, arrays={})
+    dataOffset = 0
+    for arrayName, fileArray in fileArrays.items():
+        fileHeader["arrays"][arrayName] = dict(dtype=fileArray.dtype.str, shape=fileArray.shape, offset=dataOffset)
+        dataOffset += _aligned(fileArray.nbytes)
+    headerBytes = json.dumps(fileHeader).encode()
+    dataStart = _aligned(len(fileMagic) + 8 + len(headerBytes))
+
+    # written next to its final path and then renamed, so that readers never see half a file
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(pathToFile)), suffix=".tmp",
+                                     delete=False) as arrayFile:
+        arrayFile.write(fileMagic + struct.pack("<Q", dataStart) + headerBytes)
+        for arrayName, fileArray in fileArrays.items():
+            arrayFile.seek(dataStart + fileHeader["arrays"][arrayName]["offset"])
+            arrayFile.write(numpy.ascontiguousarray(fileArray).tobytes())
+        arrayFile.truncate(dataStart + dataOffset)
+    os.replace(arrayFile.name, pathToFile)
+
+
+def _read_array_file(pathToFile, fileMagic):
+    # Returns the header and a dict of the arrays of a file written by _write_array_file, all of them
+    # read-only views of a single memory mapping of the file, so nothing is read until it is used
+
+    with open(pathToFile, 'rb') as arrayFile:
+        if arrayFile.read(len(fileMagic)) != fileMagic:
+            raise ValueError("%s is not a %s file" % (pathToFile, fileMagic.decode()))
+        dataStart, = struct.unpack("<Q", arrayFile.read(8))
+        fileHeader = json.loads(arrayFile.read(dataStart - len(fileMagic) - 8).rstrip(b"\0"))
+
+    fileMap = numpy.memmap(pathToFile, dtype=numpy.uint8, mode='r')
+    return fileHeader, {arrayName: numpy.ndarray(tuple(arrayLayout["shape"]), numpy.dtype(arrayLayout["dtype"]),
+                                                 buffer=fileMap, offset=dataStart + arrayLayout["offset"])
+                        for arrayName, arrayLayout in fileHeader["arrays"].items()}
+
+
+def is_psmc_archive(pathToPsmcFile):
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        return psmcFile.read(len(_ARCHIVE_MAGIC)) == _ARCHIVE_MAGIC
+
+
+def read_psmc_archive(pathToArchive):
+    # the header and arrays of an archive (see convert_psmc_to_archive), as views of a memory mapping
+    return _read_array_file(pathToArchive, _ARCHIVE_MAGIC)
+
+
+def _archive_last_iterations(pathToArchive, report=None):
+    # Same output as _seek_last_iterations, as views of the archive
+
+    report = report or PlotReport()
+    with report.timed("read", pathToArchive, bytes=os.path.getsize(pathToArchive)) as readStage:
+        _, archiveArrays = read_psmc_archive(pathToArchive)
+        lastThetas, lastOffsets = archiveArrays["lastThetas"], archiveArrays["lastOffsets"]
+        readStage["replicates"] = len(lastThetas)
+        if len(lastThetas) == 0:
+            return _stack_iterations([], [], [])
+        nIntervals = numpy.diff(lastOffsets)
+        if (nIntervals == nIntervals[0]).all():
+            return (lastThetas,
+                    archiveArrays["lastTimes"].reshape(len(lastThetas), nIntervals[0]),
+                    archiveArrays["lastLambdas"].reshape(len(lastThetas), nIntervals[0]))
+        return _stack_iterations(lastThetas,
+                                 numpy.split(archiveArrays["lastTimes"], lastOffsets[1:-1]),
+                                 numpy.split(archiveArrays["lastLambdas"], lastOffsets[1:-1]))
+
+
+# The round index of a text psmc file gives the byte offsets of the MM n_iterations line of every replicate
+# and of the RD line, first RS line, PA line and end of every complete round, so that any round can be read
+# with one seek. It is built in one pass and kept next to the file (same name + .psmcidx), together with the
+# size and modification time of the file it was built from: it is rebuilt as soon as the file changes.
+_INDEX_MAGIC = b"PSMCIDX1"
+_INDEX_LINES = regex.compile(rb"^(?:MM\tn_iterations:(\d+)|RD\t(\d+)$|PA\t)", regex.MULTILINE)
+
+
+def build_psmc_index(pathToPsmcFile):
+    # Returns the index arrays of a text psmc file, without reading or writing the .psmcidx file
+
+    if psmc_compression(pathToPsmcFile):
+        raise ValueError("%s is compressed and can not be indexed, convert it to an archive "
+                         "(convert_psmc_to_archive) to read single rounds" % pathToPsmcFile)
+    replicateOffsets, replicateIterations = [], []
+    roundReplicates, roundIterations, roundOffsets, rsOffsets, paOffsets, roundEnds = [], [], [], [], [], []
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        if os.fstat(psmcFile.fileno()).st_size:
+            with mmap.mmap(psmcFile.fileno(), 0, access=mmap.ACCESS_READ) as psmcBuffer:
+                openRound = None  # (RD number, offset) of the round being read
+                for indexLine in _INDEX_LINES.finditer(psmcBuffer):
+                    if indexLine.group(1) is not None:
+                        replicateOffsets.append(indexLine.start())
+                        replicateIterations.append(int(indexLine.group(1)))
+                        openRound = None
+                    elif indexLine.group(2) is not None:
+                        openRound = (int(indexLine.group(2)), indexLine.start()) if replicateOffsets else None
+                    elif openRound is not None:
+                        # PA line, the round is complete once the line is
+                        roundEnd = psmcBuffer.find(b"\n", indexLine.start()) + 1
+                        if not roundEnd:
+                            break
+                        roundIteration, roundOffset = openRound
+                        rsOffset = psmcBuffer.find(b"\nRS\t", roundOffset, indexLine.start())
+                        roundReplicates.append(len(replicateOffsets) - 1)
+                        roundIterations.append(roundIteration)
+                        roundOffsets.append(roundOffset)
+                        rsOffsets.append(rsOffset + 1 if rsOffset >= 0 else indexLine.start())
+                        paOffsets.append(indexLine.start())
+                        roundEnds.append(roundEnd)
+                        openRound = None
+
+    return {arrayName: numpy.array(indexColumn, dtype=numpy.int64) for arrayName, indexColumn in (
+        ("replicateOffsets", replicateOffsets), ("replicateIterations", replicateIterations),
+        ("roundReplicates", roundReplicates), ("roundIterations", roundIterations),
+        ("roundOffsets", roundOffsets), ("rsOffsets", rsOffsets), ("paOffsets", paOffsets),
+        ("roundEnds", roundEnds))}
+
+
+def load_psmc_index(pathToPsmcFile):
+    # The index arrays of a text psmc file, from its .psmcidx file if that is still up to date, otherwise
+    # built and saved again (unless the directory is read-only, then it is only returned)
+
+    pathToIndex = pathToPsmcFile + ".psmcidx"
+    fileStat = os.stat(pathToPsmcFile)
+    sourceFile = dict(size=fileStat.st_size, mtime_ns=fileStat.st_mtime_ns)
+    try:
+        indexHeader, indexArrays = _read_array_file(pathToIndex, _INDEX_MAGIC)
+        if indexHeader.get("source") == sourceFile:
+            return indexArrays
+    except (OSError, ValueError):
+        pass
+
+    indexArrays = build_psmc_index(pathToPsmcFile)
+    try:
+        _write_array_file(pathToIndex, _INDEX_MAGIC, dict(source=sourceFile), indexArrays)
+    except OSError:
+        pass
+    return indexArrays
+
+
+def _find_round(roundReplicates, roundIterations, replicateIterations, i_replicate, iteration):
+    # position of a round in the index (or archive), iteration None is the last round of the replicate
+
+    if not 0 <= i_replicate < len(replicateIterations):
+        raise IndexError("there is no replicate %d, the file has %d" % (i_replicate, len(replicateIterations)))
+    if iteration is None:
+        iteration = replicateIterations[i_replicate]
+    matchingRounds = numpy.flatnonzero((roundReplicates == i_replicate) & (roundIterations == iteration))
+    if not len(matchingRounds):
+        raise IndexError("replicate %d has no complete round %d" % (i_replicate, iteration))
+    return matchingRounds[0]
+
+
+def read_psmc_round(pathToPsmcFile, i_replicate, iteration=None):
+    # Returns theta, t_k and lambda_k of round RD iteration of replicate i_replicate (counted from 0 in the
+    # order of the file). Text files are read through their index, with one seek, archives directly.
+
+    if is_psmc_archive(pathToPsmcFile):
+        _, archiveArrays = read_psmc_archive(pathToPsmcFile)
+        i_round = _find_round(archiveArrays["roundReplicates"], archiveArrays["roundIterations"],
+                              archiveArrays["replicateIterations"], i_replicate, iteration)
+        rsRows = slice(archiveArrays["rsOffsets"][i_round], archiveArrays["rsOffsets"][i_round + 1])
+        return (archiveArrays["roundValues"][i_round, _ARCHIVE_ROUND_COLUMNS.index("PA_theta")],
+                archiveArrays["rsTimes"][rsRows], archiveArrays["rsLambdas"][rsRows])
+
+    indexArrays = load_psmc_index(pathToPsmcFile)
+    i_round = _find_round(indexArrays["roundReplicates"], indexArrays["roundIterations"],
+                          indexArrays["replicateIterations"], i_replicate, iteration)
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        psmcFile.seek(indexArrays["roundOffsets"][i_round])
+        iterationBlock = psmcFile.read(indexArrays["roundEnds"][i_round] - indexArrays["roundOffsets"][i_round])
+    estimatedThetas, timePoints, lambdaPoints = _read_iteration_blocks([iterationBlock])
+    return estimatedThetas[0], timePoints[0], lambdaPoints[0]
+
+
+def read_psmc_iteration(psmcFiles, representAsEffectiveSize, i_replicate, iteration=None):
+    # the scaled (time, size) curve of one round of one replicate, see read_psmc_round
+    estimatedTheta, timePoints, lambdaPoints = read_psmc_round(psmcFiles[0], i_replicate, iteration)
+    return _scale_psmc_points(timePoints, lambdaPoints, estimatedTheta, psmcFiles, representAsEffectiveSize)
+
+
+def read_psmc_rounds(pathToPsmcFile):
+    # Every round of every replicate in one pass over the file (or straight from an archive), as a dict of
+    # dense arrays: "times", "lambdas" and "pis" are (replicates x rounds x intervals) t_k, lambda_k and pi_k,
+    # and every column of _ARCHIVE_ROUND_COLUMNS ("LK", "QD_before", "QD_after", "RI", "TR_theta", ...,
+    # "PA_theta") is a (replicates x rounds) array. Round r is RD r, rounds that are missing from the file
+    # (truncated runs) and intervals past the end of a replicate with fewer intervals are NaN.
+
+    if is_psmc_archive(pathToPsmcFile):
+        _, roundArrays = read_psmc_archive(pathToPsmcFile)
+    else:
+        roundArrays = _tabulate_psmc_rounds(pathToPsmcFile)
+
+    roundReplicates, roundIterations = roundArrays["roundReplicates"], roundArrays["roundIterations"]
+    rsOffsets = roundArrays["rsOffsets"]
+    nReplicates = len(roundArrays["replicateIterations"])
+    nRounds = int(max(roundIterations.max(initial=-1), roundArrays["replicateIterations"].max(initial=-1))) + 1
+    roundIntervals = numpy.diff(rsOffsets)
+    nIntervals = int(roundIntervals.max(initial=0))
+
+    # every RS row goes to [replicate, round, k]
+    rowRounds = numpy.repeat(numpy.arange(len(roundIntervals)), roundIntervals)
+    rowIntervals = numpy.arange(len(rowRounds)) - rsOffsets[rowRounds]
+    rowReplicates, rowIterations = roundReplicates[rowRounds], roundIterations[rowRounds]
+
+    psmcRounds = {}
+    for tensorName, rsName in (("times", "rsTimes"), ("lambdas", "rsLambdas"), ("pis", "rsPis")):
+        roundTensor = numpy.full((nReplicates, nRounds, nIntervals), numpy.nan)
+        roundTensor[rowReplicates, rowIterations, rowIntervals] = roundArrays[rsName]
+        psmcRounds[tensorName] = roundTensor
+    for i_column, columnName in enumerate(_ARCHIVE_ROUND_COLUMNS):
+        roundScalars = numpy.full((nReplicates, nRounds), numpy.nan)
+        roundScalars[roundReplicates, roundIterations] = roundArrays["roundValues"][:, i_column]
+        psmcRounds[columnName] = roundScalars
+    return psmcRounds
+
+
+def scale_psmc_rounds(psmcRounds, psmcFiles, representAsEffectiveSize):
+    # (replicates x rounds x intervals) scaled times and sizes of read_psmc_rounds, each round with its own theta
+    return _scale_psmc_points(psmcRounds["times"], psmcRounds["lambdas"], psmcRounds["PA_theta"][:, :, None],
+                              psmcFiles, representAsEffectiveSize)
+
+
+def _load_last_iterations(pathToPsmcFile, useCache=True, report=None):
+    # _seek_last_iterations, going through the on-disk cache when it is enabled, or read from an archive
+
+    if is_psmc_archive(pathToPsmcFile):
+        return _archive_last_iterations(pathToPsmcFile, report)
+    if not (useCache and parseCacheDirectory):
+        return _seek_last_iterations(pathToPsmcFile, report)
+
+    report = report or PlotReport()
+    with report.timed("cache", pathToPsmcFile) as cacheStage:
+        cachePath = _parse_cache_path(pathToPsmcFile)
+        lastIterations = _read_parse_cache(cachePath)
+        cacheStage["hit"] = lastIterations is not None
+    if lastIterations is None:
+        lastIterations = _seek_last_iterations(pathToPsmcFile, report)
+        if isinstance(lastIterations[1], numpy.ndarray):
+            with report.timed("cache", pathToPsmcFile, write=True):
+                _write_parse_cache(cachePath, lastIterations)
+    return lastIterations
+
+
+def _set_parse_cache(cacheDirectory, cacheMaxBytes):
+    # for pool jobs, worker processes that are spawned rather than forked start from the module defaults
+
+    global parseCacheDirectory, parseCacheMaxBytes
+    parseCacheDirectory = cacheDirectory
+    parseCacheMaxBytes = cacheMaxBytes
+
+
+def read_psmc_raw(pathToPsmcFile, seekLastIteration=True, useCache=True, report=None):
+    # The unscaled last round of every replicate: theta (replicates,), t_k and lambda_k, as (replicates x
+    # intervals) arrays, or lists of one array per replicate if the replicates have different intervals.
+    # Scaling it (scale_psmc_raw, rescale_psmc_grid) does not need the file again.
+
+    report = report or PlotReport()
+    if seekLastIteration or is_psmc_archive(pathToPsmcFile):
+        return _load_last_iterations(pathToPsmcFile, useCache, report)
+
+    with report.timed("scan", pathToPsmcFile, bytes=os.path.getsize(pathToPsmcFile)):
+        scannedIterations = list(_scan_last_iterations(pathToPsmcFile))
+        return _stack_iterations([estimatedTheta for estimatedTheta, _, _ in scannedIterations],
+                                 [replicateTimes for _, replicateTimes, _ in scannedIterations],
+                                 [replicateLambdas for _, _, replicateLambdas in scannedIterations])
+
+
+def scale_psmc_raw(rawIterations, psmcFiles, representAsEffectiveSize, report=None):
+    # the list of scaled (time, size) replicates that parse_psmc_output returns for a file, from read_psmc_raw
+
+    report = report or PlotReport()
+    estimatedThetas, timePoints, lambdaPoints = rawIterations
+    with report.timed("scale", psmcFiles[0], replicates=len(estimatedThetas)):
+        if isinstance(timePoints, numpy.ndarray):
+            # scale all replicates of the file at once
+            scaledTimes, scaledSizes = _scale_psmc_points(timePoints, lambdaPoints, estimatedThetas[:, None],
+                                                          psmcFiles, representAsEffectiveSize)
+            return list(zip(scaledTimes, scaledSizes))
+
+        return [_scale_psmc_points(replicateTimes, replicateLambdas, estimatedTheta,
+                                   psmcFiles, representAsEffectiveSize)
+                for estimatedTheta, replicateTimes, replicateLambdas
+                in zip(estimatedThetas, timePoints, lambdaPoints)]
+
+
+def rescale_psmc_grid(rawIterations, representAsEffectiveSize, generationTimes, mutationRates, binSizes):
+    # Scales the replicates of read_psmc_raw for every combination of generation time, mutation rate and bin
+    # size in one broadcast. Returns scaled times and sizes as two (generation times x mutation rates x bin
+    # sizes x replicates x intervals) arrays, with the same values as parsing the file once per combination.
+    # Replicates with fewer intervals than the others are padded with NaN. Without representAsEffectiveSize
+    # the values do not depend on generation time and mutation rate, those axes are then read-only views.
+
+    estimatedThetas, timePoints, lambdaPoints = rawIterations
+    if not isinstance(timePoints, numpy.ndarray):
+        nIntervals = max(map(len, timePoints))
+        timePoints, lambdaPoints = (numpy.array([numpy.pad(numpy.asarray(replicatePoints, dtype=numpy.float64),
+                                                           (0, nIntervals - len(replicatePoints)),
+                                                           constant_values=numpy.nan)
+                                                 for replicatePoints in rawPoints])
+                                    for rawPoints in (timePoints, lambdaPoints))
+
+    scalingGrid = ("", numpy.asarray(generationTimes, dtype=numpy.float64).reshape(-1, 1, 1, 1, 1),
+                   numpy.asarray(mutationRates, dtype=numpy.float64).reshape(1, -1, 1, 1, 1),
+                   numpy.asarray(binSizes, dtype=numpy.float64).reshape(1, 1, -1, 1, 1))
+    scaledTimes, scaledSizes = _scale_psmc_points(timePoints, lambdaPoints, numpy.asarray(estimatedThetas)[:, None],
+                                                  scalingGrid, representAsEffectiveSize)
+    gridShape = tuple(scalingValues.size for scalingValues in scalingGrid[1:]) + timePoints.shape
+    return numpy.broadcast_to(scaledTimes, gridShape), numpy.broadcast_to(scaledSizes, gridShape)
+
+
+def _report_read_psmc_raw(pathToPsmcFile, seekLastIteration, useCache, cacheDirectory, cacheMaxBytes):
+    # pool job: a worker process cannot add to the caller's report, so its stages are sent back with the data.
+    # The cache settings of the caller come with every job (a pool initializer would need python 3.7)
+
+    _set_parse_cache(cacheDirectory, cacheMaxBytes)
+    fileReport = PlotReport()
+    return read_psmc_raw(pathToPsmcFile, seekLastIteration, useCache, fileReport), fileReport.stages
+
+
+def read_each_file_once(listOfOpt, readPsmcFile):
+    # readPsmcFile(path) for every entry of listOfOpt, called once per distinct file, for entries that list the
+    # same psmc file with other generation times, mutation rates or names, or under another path (./a.psmc, a.psmc)
+
+    fileResults = {}
+    absolutePaths = [os.path.abspath(psmcFiles[0]) for psmcFiles in listOfOpt]
+    for psmcFiles, absolutePath in zip(listOfOpt, absolutePaths):
+        if absolutePath not in fileResults:
+            fileResults[absolutePath] = readPsmcFile(psmcFiles[0])
+    return [fileResults[absolutePath] for absolutePath in absolutePaths]
+
+
+def psmc_file_fingerprints(listOfOpt):
+    # (absolute path, size, modification time) of every file in listOfOpt: a file that was rewritten (e.g. psmc
+    # was run again) gives other fingerprints, so that figures and images made from it are not reused
+
+    fileFingerprints = []
+    for psmcFiles in listOfOpt:
+        fileStat = os.stat(psmcFiles[0])
+        fileFingerprints.append((os.path.abspath(psmcFiles[0]), fileStat.st_size, fileStat.st_mtime_ns))
+    return tuple(fileFingerprints)
+
+
+def parse_psmc_output(psmcInputList, representAsEffectiveSize, seekLastIteration=True, useCache=True,
+                      nWorkers=1, useThreads=False, report=None):
 
     # TODO: apparently there is some sort of bug because my plots, when compared to Li's psmc_plot.pl plots
     # do not exactly match when the same data is used, especially when it comes to the population size.
     #
-    allPsmcData = []
-    for psmcFiles in psmcInputList:
-
-        lastIteration = ""
-        with open(psmcFiles[0], 'r') as psmcFile:
-            inBlock = False
-            timePoints, lambdaPoints, blockPoints = [], [], []
-            estimatedTheta = n0 = 0
-
-            for line in psmcFile:
-                if line.split()[0] == "MM" and line.split()[1].split(":")[0] == "n_iterations":
-                    # We could also iterate through the whole file and get the maximum RD value
-                    lastIteration = line.split()[1].split(":")[1].strip(",")
-                if line.split() == ['RD', lastIteration]:  # Last iteration
-                    inBlock = True
-                    timePoints, lambdaPoints = [], []
-                if inBlock and line[:2] == "RS":
-                    timePoints.append(float(line.split('\t')[2]))
-                    lambdaPoints.append(float(line.split('\t')[3]))
-                elif inBlock and line[:2] == "PA":
-                    inBlock = False
-                    estimatedTheta = float(line.split()[2])
-                    generationTime = psmcFiles[1]
-                    mutRate = psmcFiles[2]
-                    binSize = psmcFiles[3]
-                    n0 = estimatedTheta/(4*mutRate)/binSize
-
-                    scaledSize = scaledTime = 0
-
-                    if representAsEffectiveSize:
-                        scaledTime = [generationTime * 2 * n0 * time_k for time_k in timePoints]
-                        scaledSize = [n0 * lambda_k for lambda_k in lambdaPoints]
-                    else:
-                        scaledTime = [time_k * estimatedTheta / binSize for time_k in timePoints]
-                        # pairwiseSequenceDivergence
-                        scaledSize = [(lambda_k * estimatedTheta / binSize)*1e3 for lambda_k in lambdaPoints]
-                        # scaledMutRate
-
-                    blockPoints.append((scaledTime, scaledSize))
-        allPsmcData.append(blockPoints)
-
-    return allPsmcData
+    # seekLastIteration: jump straight to the last RD round of each replicate instead of reading the whole file
+    # useCache: reuse the parsed replicates stored in parseCacheDirectory (only with seekLastIteration)
+    # nWorkers: parse the input files in a pool of this many processes (or threads if useThreads),
+    #   the results keep the order of psmcInputList
+    # report: a PlotReport that the read, tokenize, scale (and cache) stages of every file are added to
+    # A file listed several times (e.g. with several mutation rates) is read once and scaled for every entry.
+    report = report or PlotReport()
+    absolutePaths = [os.path.abspath(psmcFiles[0]) for psmcFiles in psmcInputList]
+    distinctPaths = {}  # the path each distinct file is read under
+    for psmcFiles, absolutePath in zip(psmcInputList, absolutePaths):
+        distinctPaths.setdefault(absolutePath, psmcFiles[0])
+    if nWorkers > 1 and len(distinctPaths) > 1:
+        nInputs = len(distinctPaths)
+        if useThreads:
+            parsePool = concurrent.futures.ThreadPoolExecutor(max_workers=nWorkers)
+        else:
+            parsePool = concurrent.futures.ProcessPoolExecutor(max_workers=min(nWorkers, nInputs))
+        rawByPath = {}
+        with parsePool:
+            for absolutePath, (rawIterations, fileStages) in zip(distinctPaths, parsePool.map(
+                    _report_read_psmc_raw, distinctPaths.values(), [seekLastIteration] * nInputs,
+                    [useCache] * nInputs, [parseCacheDirectory] * nInputs, [parseCacheMaxBytes] * nInputs)):
+                rawByPath[absolutePath] = rawIterations
+                report.stages += fileStages
+        fileIterations = [rawByPath[absolutePath] for absolutePath in absolutePaths]
+    else:
+        fileIterations = read_each_file_once(
+            psmcInputList, lambda pathToPsmcFile: read_psmc_raw(pathToPsmcFile, seekLastIteration, useCache, report))
+
+    return [scale_psmc_raw(rawIterations, psmcFiles, representAsEffectiveSize, report)
+            for rawIterations, psmcFiles in zip(fileIterations, psmcInputList)]
+
+
+def iter_psmc_replicates(psmcFiles, representAsEffectiveSize, seekLastIteration=True):
+
+    # Yields the scaled (time, size) arrays of one replicate at a time, as soon as its last round has been read,
+    # so memory use does not depend on the number of replicates in the file
+    if is_psmc_archive(psmcFiles[0]):
+        for estimatedTheta, timePoints, lambdaPoints in zip(*_archive_last_iterations(psmcFiles[0])):
+            yield _scale_psmc_points(timePoints, lambdaPoints, estimatedTheta, psmcFiles, representAsEffectiveSize)
+    elif seekLastIteration and psmc_compression(psmcFiles[0]):
+        with _open_psmc_file(psmcFiles[0]) as psmcStream:
+            for iterationBlock in _iter_stream_iteration_blocks(psmcStream):
+                estimatedThetas, timePoints, lambdaPoints = _read_iteration_blocks([iterationBlock])
+                yield _scale_psmc_points(timePoints[0], lambdaPoints[0], estimatedThetas[0],
+                                         psmcFiles, representAsEffectiveSize)
+    elif seekLastIteration:
+        with open(psmcFiles[0], 'rb') as psmcFile:
+            if os.fstat(psmcFile.fileno()).st_size == 0:
+                return
+            with mmap.mmap(psmcFile.fileno(), 0, access=mmap.ACCESS_READ) as psmcBuffer:
+                for blockStart, blockEnd in _find_last_iteration_blocks(psmcBuffer):
+                    estimatedThetas, timePoints, lambdaPoints = _read_iteration_blocks(
+                        [psmcBuffer[blockStart:blockEnd]])
+                    yield _scale_psmc_points(timePoints[0], lambdaPoints[0], estimatedThetas[0],
+                                             psmcFiles, representAsEffectiveSize)
+    else:
+        for estimatedTheta, timePoints, lambdaPoints in _scan_last_iterations(psmcFiles[0]):
+            yield _scale_psmc_points(timePoints, lambdaPoints, estimatedTheta, psmcFiles, representAsEffectiveSize)
+
+
+def _step_vertices(sampleReplicates):
+    # Vertices of the default step(where="pre") line of every replicate, for drawing them as one LineCollection
+
+    if len({len(scaledTime) for scaledTime, _ in sampleReplicates}) != 1:
+        return [_step_vertices([replicate])[0] for replicate in sampleReplicates]
+
+    scaledTimes = numpy.array([scaledTime for scaledTime, _ in sampleReplicates])
+    scaledSizes = numpy.array([scaledSize for _, scaledSize in sampleReplicates])
+    stepVertices = numpy.empty((scaledTimes.shape[0], max(2 * scaledTimes.shape[1] - 1, 0), 2))
+    stepVertices[:, 0::2, 0] = scaledTimes
+    stepVertices[:, 1::2, 0] = scaledTimes[:, :-1]
+    stepVertices[:, 0::2, 1] = scaledSizes
+    stepVertices[:, 1::2, 1] = scaledSizes[:, 1:]
+    return stepVertices
+
+
+def _resample_steps(sampleReplicates, gridSize=512, timeGrid=None):
+
+    # The step functions of all replicates of a sample on one time grid (log-spaced over the replicates' time
+    # range unless timeGrid is given): (timeGrid, replicates x grid sizes), NaN past the end of a replicate
+    nIntervals = max(len(scaledTime) for scaledTime, _ in sampleReplicates)
+    scaledTimes = numpy.full((len(sampleReplicates), nIntervals), numpy.inf)
+    scaledSizes = numpy.full((len(sampleReplicates), nIntervals), numpy.nan)
+    for j_bootStrap, (scaledTime, scaledSize) in enumerate(sampleReplicates):
+        scaledTimes[j_bootStrap, :len(scaledTime)] = scaledTime
+        scaledSizes[j_bootStrap, :len(scaledSize)] = scaledSize
+
+    if timeGrid is None:
+        finiteTimes = scaledTimes[numpy.isfinite(scaledTimes) & (scaledTimes > 0)]
+        timeGrid = numpy.geomspace(finiteTimes.min(), finiteTimes.max(), gridSize)
+    timeGrid = numpy.asarray(timeGrid, dtype=numpy.float64)
+    nGrid = len(timeGrid)
+
+    # step(where="pre") takes the value lambda_k on (t_k-1, t_k], i.e. at a grid time g it is the size of the
+    # first interval with t_k >= g, whose index is the number of t_k < g. That count is found for all
+    # replicates at once by binning every t_k by the first grid time above it and summing the bins.
+    firstGridAbove = numpy.searchsorted(timeGrid, scaledTimes, side="right")
+    firstGridAbove += (nGrid + 1) * numpy.arange(len(scaledTimes))[:, None]
+    nTimesBelow = numpy.bincount(firstGridAbove.ravel(), minlength=(nGrid + 1) * len(scaledTimes))
+    nTimesBelow = numpy.cumsum(nTimesBelow.reshape(len(scaledTimes), nGrid + 1), axis=1)[:, :nGrid]
+
+    gridSizes = numpy.take_along_axis(scaledSizes, numpy.minimum(nTimesBelow, nIntervals - 1), axis=1)
+    gridSizes[nTimesBelow >= nIntervals] = numpy.nan
+    return timeGrid, gridSizes
+
+
+def summarize_bootstraps(sampleReplicates, percentiles=(2.5, 97.5), gridSize=512, timeGrid=None):
+
+    # Resamples the step functions of all replicates of a sample on one time grid (log-spaced over the
+    # replicates' time range unless timeGrid is given) and returns (timeGrid, median, lower, upper).
+    # Times past the end of a replicate are left out of its percentiles.
+    timeGrid, gridSizes = _resample_steps(list(sampleReplicates), gridSize, timeGrid)
+    lowerBand, median, upperBand = numpy.nanpercentile(gridSizes, (percentiles[0], 50, percentiles[1]), axis=0)
+    return timeGrid, median, lowerBand, upperBand
+
+
+def bootstrap_density(sampleReplicates, timeBins=256, sizeBins=128, sizeRange=None):
+
+    # 2-D histogram of the step functions of all replicates of a sample over (log time, size): every
+    # replicate is resampled at the centre of each of timeBins log-spaced time bins and counted in the size
+    # bin it is in there. Returns (timeEdges, sizeEdges, density), density[size bin, time bin] being the
+    # fraction of the replicates that reach that time which are in that size bin. The cost grows with the
+    # number of replicates only in the resampling and binning, the drawn image always has the same size.
+    # sizeRange: (lowest, highest) size binned, default from 0 to the 99.5th percentile of the sizes, so that a
+    #   few outlying replicates do not squeeze all the others into the lowest bins
+    sampleReplicates = list(sampleReplicates)
+    finiteTimes = numpy.concatenate([numpy.asarray(scaledTime, dtype=numpy.float64)
+                                     for scaledTime, _ in sampleReplicates])
+    finiteTimes = finiteTimes[numpy.isfinite(finiteTimes) & (finiteTimes > 0)]
+    timeEdges = numpy.geomspace(finiteTimes.min(), finiteTimes.max(), timeBins + 1)
+    _, gridSizes = _resample_steps(sampleReplicates, timeGrid=numpy.sqrt(timeEdges[:-1] * timeEdges[1:]))
+
+    if sizeRange is None:
+        sizeRange = (0, numpy.nanpercentile(gridSizes, 99.5))
+    sizeEdges = numpy.linspace(sizeRange[0], sizeRange[1], sizeBins + 1)
+    # sizes outside sizeRange and the NaN past the end of a replicate fall in the extra bins 0 and sizeBins + 1
+    sizeIndex = numpy.searchsorted(sizeEdges, numpy.where(numpy.isnan(gridSizes), numpy.inf, gridSizes), side="right")
+    sizeIndex[gridSizes == sizeRange[1]] = sizeBins
+    binCounts = numpy.bincount((sizeIndex * timeBins + numpy.arange(timeBins)).ravel(),
+                               minlength=(sizeBins + 2) * timeBins).reshape(sizeBins + 2, timeBins)
+
+    nReaching = numpy.count_nonzero(~numpy.isnan(gridSizes), axis=0)
+    density = binCounts[1:-1] / numpy.maximum(nReaching, 1)
+    return timeEdges, sizeEdges, density
+
+
+def export_bootstrap_summary(pathToSummary, bootstrapSummary, percentiles=(2.5, 97.5)):
+
+    timeGrid, median, lowerBand, upperBand = bootstrapSummary
+    numpy.savetxt(pathToSummary, numpy.column_stack((timeGrid, median, lowerBand, upperBand)),
+                  delimiter="\t", fmt="%.6g",
+                  header="time\tmedian\tpercentile_%g\tpercentile_%g" % percentiles)
+    return pathToSummary
+
+
+_STREAM_CHUNK_REPLICATES = 256
+
+
+def _ignore_progress(message):
+    pass
+
+
+class PsmcFigure:
+    # The data artists of a plot are built once for a set of samples, set_options then only changes the axis
+    # limits and scales, the bootstrap transparency and the LGM marker of the existing artists
+
+    def __init__(self, listOfOpt, yAsEffectiveSize,
+                 savePlotWithName="myPlot", nWorkers=1, streamReplicates=False, plotDirectory="./Plots",
+                 bootstrapStyle="collection", summaryPercentiles=(2.5, 97.5), exportSummary=False,
+                 reportProgress=_ignore_progress, report=None):
+
+        # reportProgress: callable that is given a short message at the start of every stage
+        # report: PlotReport given the parse stages and an artists stage per sample
+        # streamReplicates: read the replicates of a file one at a time while they are drawn, so that only the
+        #   drawn lines are kept ("steps", "collection"). The percentiles of "summary" and the bins of "density"
+        #   need every replicate at once, they can not be streamed.
+        if streamReplicates and bootstrapStyle in ("summary", "density"):
+            raise ValueError("streamReplicates only works with the steps and collection bootstrap styles, "
+                             "%s needs every replicate at once" % bootstrapStyle)
+        report = report or PlotReport()
+        self.sampleKey = PsmcFigure.sample_key(listOfOpt, yAsEffectiveSize, bootstrapStyle, summaryPercentiles)
+        # taken before the files are read, a file rewritten while it is read is then read again next time
+        self.fileFingerprints = psmc_file_fingerprints(listOfOpt)
+        self.yAsEffectiveSize = yAsEffectiveSize
+        self.bootstrapArtists = []
+
+        # A figure of our own rather than pyplot's global figure(1), so that several plots can be
+        # rendered at the same time (threads, processes) and no GUI backend is ever needed.
+        # The first figure of a process also imports matplotlib.
+        with report.timed("figure"):
+            self.figure = mfigure.Figure()
+            backend_agg.FigureCanvasAgg(self.figure)
+            inFigure = self.axes = self.figure.add_subplot(111)
+
+            # Last Glacial Maximum, hidden unless showLGM
+            self.lgmLine = inFigure.axvline(
+                linewidth=10,
+                alpha=0.25,
+                label=None,  # label="LGM",
+                x=22000,
+                color='black',
+                visible=False)
+
+        reportProgress("Reading %d PSMC file(s)..." % len(listOfOpt))
+        if streamReplicates:
+            # draw replicates while they are read instead of parsing every file first
+            myData = (iter_psmc_replicates(psmcFiles, yAsEffectiveSize) for psmcFiles in listOfOpt)
+        else:
+            myData = parse_psmc_output(listOfOpt, representAsEffectiveSize=yAsEffectiveSize, nWorkers=nWorkers,
+                                       report=report)
+
+        # bootstrapStyle: "collection" draws all replicates of a sample as a single artist,
+        #   "steps" draws one step() line per replicate,
+        #   "summary" draws the median and a summaryPercentiles band of the replicates instead of every line,
+        #   exportSummary also writes that summary next to the plot,
+        #   "density" draws a 2-D histogram of the replicates over (log time, size) as one image, see
+        #   bootstrap_density, whose drawing time does not grow with the number of replicates
+        for i_sample, sampleReplicates in enumerate(myData):
+
+            reportProgress("Drawing %s (%d of %d)..." % (listOfOpt[i_sample][4], i_sample + 1, len(listOfOpt)))
+            # when streaming, reading the replicates is part of this stage
+            with report.timed("artists", listOfOpt[i_sample][4]) as artistsEntry:
+                nArtists = len(inFigure.get_children())
+                originalPsmc = None
+                # bootstraped psmc
+                if bootstrapStyle == "steps":
+                    for scaledTime, scaledSize in sampleReplicates:
+                        if originalPsmc is None:
+                            originalPsmc = (scaledTime, scaledSize)
+                        self.bootstrapArtists += inFigure.step(scaledTime,
+                                                               scaledSize,
+                                                               color=listOfOpt[i_sample][5],
+                                                               linewidth=1.0)
+                elif bootstrapStyle == "summary":
+                    sampleReplicates = list(sampleReplicates)
+                    if sampleReplicates:
+                        originalPsmc = sampleReplicates[0]
+                        bootstrapSummary = summarize_bootstraps(sampleReplicates, summaryPercentiles)
+                        timeGrid, median, lowerBand, upperBand = bootstrapSummary
+                        self.bootstrapArtists.append(inFigure.fill_between(timeGrid, lowerBand, upperBand,
+                                                                           color=listOfOpt[i_sample][5],
+                                                                           linewidth=0))
+                        inFigure.plot(timeGrid, median,
+                                      color=listOfOpt[i_sample][5],
+                                      linewidth=1.0,
+                                      linestyle="--")
+                        if exportSummary:
+                            os.makedirs(plotDirectory, exist_ok=True)
+                            export_bootstrap_summary(
+                                os.path.join(plotDirectory,
+                                             "%s_%s_summary.tsv" % (savePlotWithName, listOfOpt[i_sample][4])),
+                                bootstrapSummary, summaryPercentiles)
+                elif bootstrapStyle == "density":
+                    sampleReplicates = list(sampleReplicates)
+                    if sampleReplicates:
+                        originalPsmc = sampleReplicates[0]
+                        timeEdges, sizeEdges, density = bootstrap_density(sampleReplicates)
+                        # from transparent to the colour of the sample, so that the images of several
+                        # samples can be seen through each other
+                        sampleColor = mcolors.to_rgb(listOfOpt[i_sample][5])
+                        densityColors = mcolors.LinearSegmentedColormap.from_list(
+                            "density", [sampleColor + (0,), sampleColor + (1,)])
+                        # rasterized: in svg and pdf the image is one bitmap instead of a path per bin
+                        # saturated above the 99th percentile, a few bins where most replicates agree (such
+                        # as the most recent intervals) would otherwise make all the others invisible
+                        inFigure.pcolormesh(timeEdges, sizeEdges, numpy.ma.masked_equal(density, 0),
+                                            cmap=densityColors, vmin=0,
+                                            vmax=numpy.percentile(density[density > 0], 99) if density.any() else 1,
+                                            rasterized=True)
+                else:
+                    # the vertices are made _STREAM_CHUNK_REPLICATES replicates at a time, so a stream of
+                    # replicates is never held in memory next to its vertices
+                    replicateStream = iter(sampleReplicates)
+                    stepVertices = []
+                    for replicateChunk in iter(
+                            lambda: list(itertools.islice(replicateStream, _STREAM_CHUNK_REPLICATES)), []):
+                        if originalPsmc is None:
+                            originalPsmc = replicateChunk[0]
+                        stepVertices.extend(_step_vertices(replicateChunk))
+                    if stepVertices:
+                        self.bootstrapArtists.append(inFigure.add_collection(
+                            mcollections.LineCollection(stepVertices,
+                                                        colors=listOfOpt[i_sample][5],
+                                                        linewidths=1.0,
+                                                        capstyle="projecting",  # same as Line2D
+                                                        joinstyle="round")))
+                # original psmc
+                if originalPsmc is not None:
+                    inFigure.step(originalPsmc[0],
+                                  originalPsmc[1],
+                                  color=listOfOpt[i_sample][5],
+                                  label=listOfOpt[i_sample][4])
+                artistsEntry["artists"] = len(inFigure.get_children()) - nArtists
+        # the "best" location would be tried against every bin of the density images, which takes longer than
+        # drawing them
+        inFigure.legend(loc="upper right" if bootstrapStyle == "density" else 0)
+        self.figure.suptitle("PSMC estimate on real data")
+
+        if yAsEffectiveSize:
+            inFigure.set_xlabel("Years")
+            inFigure.set_ylabel("Effective population size")
+            inFigure.set_title("Y axis scaled as $N_e$")
+        else:
+            inFigure.set_xlabel(r'Time (scaled in units of 2$\mu$T)')
+            inFigure.set_ylabel("Population size\n(scaled in units of $4\\mu N_e\\ x\\ 10^3$)")
+            inFigure.set_title("Y axis scaled as $4\\mu N_e\\ x\\ 10^3$")
+
+    @staticmethod
+    def sample_key(listOfOpt, yAsEffectiveSize, bootstrapStyle="collection", summaryPercentiles=(2.5, 97.5)):
+        # figures with the same key have the same data artists
+        return tuple(map(tuple, listOfOpt)), yAsEffectiveSize, bootstrapStyle, tuple(summaryPercentiles)
+
+    def set_options(self, xmin=0, xmax=0,
+                    ymin=0, ymax=0,
+                    transparency=0.1, isXLogScale=True, isYLogScale=False, showLGM=False):
+
+        OOMFormatter = _oom_formatter_class()
+        inFigure = self.axes
+        self.lgmLine.set_visible(showLGM)
+        for bootstrapArtist in self.bootstrapArtists:
+            bootstrapArtist.set_alpha(transparency)
+
+        sumAxes = xmin+xmax+ymin+ymax
+
+        if isXLogScale:
+            inFigure.set_xscale("log")
+        else:
+            inFigure.set_xscale("linear")
+            xOoMagnitude = numpy.floor(numpy.log10(numpy.abs(xmax)))
+            inFigure.xaxis.set_major_formatter(OOMFormatter(xOoMagnitude, "%1.1f"))
+
+        if isYLogScale:
+            inFigure.set_yscale("log")
+        else:
+            inFigure.set_yscale("linear")
+
+        if self.yAsEffectiveSize:
+            if sumAxes == 0:
+                xmin = 1e3; xmax = 1e7; ymin = 0; ymax = 5e4
+
+            if ymax <= 1e4:
+                inFigure.yaxis.set_major_formatter(OOMFormatter(4, "%1.2f"))
+            elif ymax <= 1e5:
+                inFigure.yaxis.set_major_formatter(OOMFormatter(4, "%1.1f"))
+            elif ymax <= 1e7:
+                inFigure.yaxis.set_major_formatter(OOMFormatter(4, "%1.0f"))
+            elif ymax > 1e7:
+                yOoMagnitude = numpy.floor(numpy.log10(numpy.abs(ymax)))
+                inFigure.yaxis.set_major_formatter(OOMFormatter(yOoMagnitude, "%1.2f"))
+
+        else:
+            if sumAxes == 0:
+                xmin = 1e-6; xmax = 1e-2; ymin = 0; ymax = 5e0
+            inFigure.yaxis.set_major_formatter(OOMFormatter(0, "%1.0f"))
+
+        inFigure.grid(True)
+        inFigure.set_xlim(xmin, xmax)
+        inFigure.set_ylim(ymin, ymax)
+
+        return self.figure
+
+
+def buildPsmcFigure(listOfOpt, yAsEffectiveSize,
+                    xmin=0, xmax=0,
+                    ymin=0, ymax=0,
+                    transparency=0.1, isXLogScale=True, isYLogScale=False, showLGM=False,
+                    savePlotWithName="myPlot", nWorkers=1, streamReplicates=False, plotDirectory="./Plots",
+                    bootstrapStyle="collection", summaryPercentiles=(2.5, 97.5), exportSummary=False,
+                    reportProgress=_ignore_progress, report=None):
+
+    # Everything plotPsmc does except saving the figure, which is returned (already attached to an Agg canvas)
+    report = report or PlotReport()
+    psmcFigure = PsmcFigure(listOfOpt, yAsEffectiveSize, savePlotWithName, nWorkers, streamReplicates, plotDirectory,
+                            bootstrapStyle, summaryPercentiles, exportSummary, reportProgress, report)
+    with report.timed("axes"):
+        return psmcFigure.set_options(xmin, xmax, ymin, ymax, transparency, isXLogScale, isYLogScale, showLGM)
 
 
 def plotPsmc(listOfOpt, yAsEffectiveSize,
              xmin=0, xmax=0,
              ymin=0, ymax=0,
              transparency=0.1, isXLogScale=True, isYLogScale=False, showLGM=False,
-             savePlotWithName="myPlot"):
-
-    myFigure = pplot.figure(1)
-    inFigure = myFigure.add_subplot(111)
-
-    # Show Last Glacial Maximum?
-    if showLGM:
-        inFigure.axvline(
-            linewidth=10,
-            alpha=0.25,
-            label=None,  # label="LGM",
-            x=22000,
-            color='black')
-
-    myData = parse_psmc_output(listOfOpt, representAsEffectiveSize=yAsEffectiveSize)
-
-    for i_sample in range(0, len(myData)):
-
-        # bootstraped psmc
-        for j_bootStrap in range(0, len(myData[i_sample])):
-            inFigure.step(myData[i_sample][j_bootStrap][0],
-                          myData[i_sample][j_bootStrap][1],
-                          color=listOfOpt[i_sample][5],
-                          linewidth=1.0,
-                          alpha=transparency)
-        # original psmc
-        inFigure.step(myData[i_sample][0][0],
-                      myData[i_sample][0][1],
-                      color=listOfOpt[i_sample][5],
-                      label=listOfOpt[i_sample][4])
-    inFigure.legend(loc=0)
-    myFigure.suptitle("PSMC estimate on real data")
+             savePlotWithName="myPlot", nWorkers=1, streamReplicates=False, plotDirectory="./Plots",
+             bootstrapStyle="collection", summaryPercentiles=(2.5, 97.5), exportSummary=False,
+             reportProgress=_ignore_progress, report=None, profilePath=None):
 
-    sumAxes = xmin+xmax+ymin+ymax
+    # report: PlotReport that the timings of every stage are added to, see PlotReport
+    # profilePath: also run the whole plot under cProfile and write the pstats file there
+    #   (files parsed in worker processes are not profiled)
+    if profilePath is not None:
+        import cProfile
+        plotProfile = cProfile.Profile()
+        try:
+            return plotProfile.runcall(plotPsmc, listOfOpt, yAsEffectiveSize, xmin, xmax, ymin, ymax,
+                                       transparency, isXLogScale, isYLogScale, showLGM,
+                                       savePlotWithName, nWorkers, streamReplicates, plotDirectory,
+                                       bootstrapStyle, summaryPercentiles, exportSummary, reportProgress, report)
+        finally:
+            plotProfile.dump_stats(profilePath)
 
-    if isXLogScale:
-        inFigure.set_xscale("log")
-    else:
-        inFigure.set_xscale("linear")
-        xOoMagnitude = numpy.floor(numpy.log10(numpy.abs(xmax)))
-        inFigure.xaxis.set_major_formatter(OOMFormatter(xOoMagnitude, "%1.1f"))
+    report = report or PlotReport()
+    myFigure = buildPsmcFigure(listOfOpt, yAsEffectiveSize, xmin, xmax, ymin, ymax,
+                               transparency, isXLogScale, isYLogScale, showLGM,
+                               savePlotWithName, nWorkers, streamReplicates, plotDirectory,
+                               bootstrapStyle, summaryPercentiles, exportSummary, reportProgress, report)
 
-    if isYLogScale:
-        inFigure.set_yscale("log")
-    else:
-        inFigure.set_yscale("linear")
+    os.makedirs(plotDirectory, exist_ok=True)
 
-    if yAsEffectiveSize:
-        pplot.xlabel("Years")
-        pplot.ylabel("Effective population size")
-        pplot.title("Y axis scaled as $N_e$")
-        if sumAxes == 0:
-            xmin = 1e3; xmax = 1e7; ymin = 0; ymax = 5e4
-
-        if ymax <= 1e4:
-            inFigure.yaxis.set_major_formatter(OOMFormatter(4, "%1.2f"))
-        elif ymax <= 1e5:
-            inFigure.yaxis.set_major_formatter(OOMFormatter(4, "%1.1f"))
-        elif ymax <= 1e7:
-            inFigure.yaxis.set_major_formatter(OOMFormatter(4, "%1.0f"))
-        elif ymax > 1e7:
-            yOoMagnitude = numpy.floor(numpy.log10(numpy.abs(ymax)))
-            inFigure.yaxis.set_major_formatter(OOMFormatter(yOoMagnitude, "%1.2f"))
+    reportProgress("Saving %s..." % savePlotWithName)
+    pathToPlot = os.path.join(plotDirectory, savePlotWithName)
+    # savefig renders the figure, so this is the draw time as well
+    with report.timed("save", pathToPlot):
+        myFigure.savefig(pathToPlot)
+    return pathToPlot
+
+
+# what export_psmc_figure writes unless told otherwise: (format, dpi) pairs, a dpi of None keeps the figure's own
+# (for svg and pdf it only applies to the parts that are rasterised)
+defaultExportFormats = (("png", 100), ("png", 300), ("svg", None), ("pdf", None))
+
+
+def _export_path(pathWithoutExtension, exportFormat, dpi, exportFormats):
+    # the dpi is only added to the name when the same format is written at several resolutions
+    if dpi is not None and sum(otherFormat == exportFormat for otherFormat, _ in exportFormats) > 1:
+        return "%s_%ddpi.%s" % (pathWithoutExtension, dpi, exportFormat)
+    return "%s.%s" % (pathWithoutExtension, exportFormat)
 
+
+def _save_figure(psmcFigure, pathToPlot, exportFormat, dpi, figureReport):
+    saveOptions = dict(format=exportFormat) if dpi is None else dict(format=exportFormat, dpi=dpi)
+    with figureReport.timed("export", pathToPlot, **({} if dpi is None else dict(dpi=dpi))):
+        psmcFigure.savefig(pathToPlot, **saveOptions)
+
+
+def _save_pickled_figure(pickledFigure, pathToPlot, exportFormat, dpi):
+    # pool job: a figure can not be drawn by several threads at once, so every worker process draws its own
+    # copy of it; its stage is sent back like in _report_read_psmc_raw
+    figureReport = PlotReport()
+    _save_figure(pickle.loads(pickledFigure), pathToPlot, exportFormat, dpi, figureReport)
+    return figureReport.stages
+
+
+def export_psmc_figure(psmcFigure, pathWithoutExtension, exportFormats=defaultExportFormats, nWorkers=None,
+                       report=None):
+
+    # Writes one built figure in several formats and resolutions, e.g. a png preview, a 300 dpi png, an svg
+    # and a pdf, without building it again. With more than one format the files are written at the same time
+    # by up to nWorkers processes (default: one per format and cpu), each drawing its own unpickled copy of the
+    # figure; with one worker they are written one after the other in this process.
+    # Returns [(path, seconds)] in the order of exportFormats; the export stages are also added to report.
+    report = report or PlotReport()
+    exportPaths = [_export_path(pathWithoutExtension, exportFormat, dpi, exportFormats)
+                   for exportFormat, dpi in exportFormats]
+    parentDirectory = os.path.dirname(pathWithoutExtension)
+    if parentDirectory:
+        os.makedirs(parentDirectory, exist_ok=True)
+
+    exportStages = []
+    nWorkers = min(nWorkers or os.cpu_count() or 1, len(exportFormats))
+    if nWorkers > 1:
+        with report.timed("pickle", pathWithoutExtension) as pickleEntry:
+            pickledFigure = pickle.dumps(psmcFigure, pickle.HIGHEST_PROTOCOL)
+            pickleEntry["bytes"] = len(pickledFigure)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nWorkers) as exportPool:
+            for figureStages in exportPool.map(_save_pickled_figure, [pickledFigure] * len(exportPaths),
+                                               exportPaths, *zip(*exportFormats)):
+                exportStages += figureStages
     else:
-        pplot.xlabel(r'Time (scaled in units of 2$\mu$T)')
-        pplot.ylabel("Population size\n(scaled in units of $4\mu N_e\ x\ 10^3$)")
-        pplot.title("Y axis scaled as $4\mu N_e\ x\ 10^3$")
-        if sumAxes == 0:
-            xmin = 1e-6; xmax = 1e-2; ymin = 0; ymax = 5e0
-        inFigure.yaxis.set_major_formatter(OOMFormatter(0, "%1.0f"))
+        figureReport = PlotReport()
+        for pathToPlot, (exportFormat, dpi) in zip(exportPaths, exportFormats):
+            _save_figure(psmcFigure, pathToPlot, exportFormat, dpi, figureReport)
+        exportStages = figureReport.stages
+
+    report.stages += exportStages
+    return [(exportStage["subject"], exportStage["seconds"]) for exportStage in exportStages]
+
+
+def export_psmc_plot(listOfOpt, yAsEffectiveSize, exportFormats=defaultExportFormats, nExportWorkers=None,
+                     savePlotWithName="myPlot", plotDirectory="./Plots", report=None, **plotOptions):
+
+    # plotPsmc for several formats: the figure is built once and written by export_psmc_figure,
+    # plotOptions are the other options of plotPsmc. Returns [(path, seconds)].
+    report = report or PlotReport()
+    myFigure = buildPsmcFigure(listOfOpt, yAsEffectiveSize, savePlotWithName=savePlotWithName,
+                               plotDirectory=plotDirectory, report=report, **plotOptions)
+    return export_psmc_figure(myFigure, os.path.join(plotDirectory, os.path.splitext(savePlotWithName)[0]),
+                              exportFormats, nExportWorkers, report)
 
+
+def build_convergence_figure(listOfOpt, sampleRounds=None):
+
+    # Convergence of the EM rounds of every sample: log-likelihood, Q after the optimisation, theta and the
+    # largest relative change of the scaled curve since the previous round, one line per replicate.
+    # sampleRounds: read_psmc_rounds of every file in listOfOpt, if already read
+    if sampleRounds is None:
+        sampleRounds = read_each_file_once(listOfOpt, read_psmc_rounds)
+
+    convergenceFigure = mfigure.Figure(figsize=(10, 7))
+    backend_agg.FigureCanvasAgg(convergenceFigure)
+    panels = convergenceFigure.subplots(2, 2, sharex=True)
+    for psmcFiles, psmcRounds in zip(listOfOpt, sampleRounds):
+        _, scaledSizes = scale_psmc_rounds(psmcRounds, psmcFiles, True)
+        # fmax ignores the NaN of missing rounds and intervals
+        curveChange = numpy.fmax.reduce(numpy.abs(numpy.diff(numpy.log(scaledSizes), axis=1)), axis=2,
+                                        initial=numpy.nan)
+        rounds = numpy.arange(scaledSizes.shape[1])
+        # round 0 only holds the starting values (LK and QD are 0)
+        for panel, roundValues in zip(panels.flat, (psmcRounds["LK"][:, 1:], psmcRounds["QD_after"][:, 1:],
+                                                    psmcRounds["PA_theta"][:, 1:], curveChange)):
+            roundLines = panel.plot(rounds[1:], roundValues.T, color=psmcFiles[5], linewidth=1.0, alpha=0.5)
+            if roundLines:
+                roundLines[0].set_label(psmcFiles[4])
+
+    panelTitles = ("Log-likelihood (LK)", "Q after optimisation (QD)", r"$\theta_0$ (PA)",
+                   "Largest change of log $N_e$ since the previous round")
+    for panel, panelTitle in zip(panels.flat, panelTitles):
+        panel.set_title(panelTitle, fontsize="medium")
+        panel.grid(True)
+    panels[1, 1].set_yscale("log")
+    for panel in panels[1]:
+        panel.set_xlabel("Round of iterations (RD)")
+    panels[0, 0].legend(loc=0)
+    convergenceFigure.suptitle("PSMC convergence")
+    return convergenceFigure
+
+
+def animate_psmc_rounds(listOfOpt, yAsEffectiveSize, pathToAnimation, sampleRounds=None,
+                        framesPerSecond=4, transparency=0.1):
+
+    # One frame per round of iterations, showing the curves of every sample at that round (the first
+    # replicate opaque, the bootstrap replicates with transparency). A .gif is written with pillow, other
+    # formats need the matching matplotlib writer (e.g. ffmpeg for .mp4).
+    # sampleRounds: read_psmc_rounds of every file in listOfOpt, if already read
+    import matplotlib.animation as manimation
+    if sampleRounds is None:
+        sampleRounds = read_each_file_once(listOfOpt, read_psmc_rounds)
+
+    animationFigure = mfigure.Figure()
+    backend_agg.FigureCanvasAgg(animationFigure)
+    inFigure = animationFigure.add_subplot(111)
+
+    scaledRounds, roundCollections = [], []
+    for psmcFiles, psmcRounds in zip(listOfOpt, sampleRounds):
+        scaledTimes, scaledSizes = scale_psmc_rounds(psmcRounds, psmcFiles, yAsEffectiveSize)
+        scaledRounds.append((scaledTimes, scaledSizes))
+        replicateColors = [mcolors.to_rgba(psmcFiles[5])] + \
+            [mcolors.to_rgba(psmcFiles[5], transparency)] * (len(scaledTimes) - 1)
+        roundCollections.append(inFigure.add_collection(mcollections.LineCollection(
+            [], colors=replicateColors, linewidths=1.0, label=psmcFiles[4])))
+
+    # the axes fit every round, so that they stay the same across frames
+    allTimes = numpy.concatenate([scaledTimes[scaledTimes > 0] for scaledTimes, _ in scaledRounds])
+    allSizes = numpy.concatenate([scaledSizes[numpy.isfinite(scaledSizes)] for _, scaledSizes in scaledRounds])
+    inFigure.set_xscale("log")
+    if len(allTimes):
+        inFigure.set_xlim(allTimes.min(), allTimes.max())
+        inFigure.set_ylim(0, 1.05 * allSizes.max())
     inFigure.grid(True)
-    inFigure.set_xlim(xmin, xmax)
-    inFigure.set_ylim(ymin, ymax)
+    inFigure.legend(loc=0)
+    if yAsEffectiveSize:
+        inFigure.set_xlabel("Years")
+        inFigure.set_ylabel("Effective population size")
+    else:
+        inFigure.set_xlabel(r'Time (scaled in units of 2$\mu$T)')
+        inFigure.set_ylabel("Population size\n(scaled in units of $4\\mu N_e\\ x\\ 10^3$)")
 
-    if not os.path.exists("./Plots"):
-        os.mkdir("./Plots/")
+    def draw_round(i_round):
+        for roundCollection, (scaledTimes, scaledSizes) in zip(roundCollections, scaledRounds):
+            if i_round < scaledTimes.shape[1] and len(scaledTimes):
+                roundCollection.set_segments(_step_vertices(list(zip(scaledTimes[:, i_round],
+                                                                     scaledSizes[:, i_round]))))
+            else:
+                roundCollection.set_segments([])
+        inFigure.set_title("Round of iterations %d" % i_round)
+        return roundCollections
 
-    myFigure.savefig("./Plots/"+savePlotWithName)
-    myFigure.clf()  # close/clear fig so that it doesnt keep using resources
-    # pplot.close(1) # can't actually close figure because of current conflict with tkinter GUI
+    nRounds = max([scaledTimes.shape[1] for scaledTimes, _ in scaledRounds] + [1])
+    roundAnimation = manimation.FuncAnimation(animationFigure, draw_round, frames=nRounds)
+    roundAnimation.save(pathToAnimation, fps=framesPerSecond,
+                        writer="pillow" if pathToAnimation.lower().endswith(".gif") else None)
+    return pathToAnimation
 
 
-def readPsmcOptions(pathToOptionsFile):
+def build_sensitivity_figure(psmcFiles, generationTimes, mutationRates, rawIterations=None):
+
+    # How the estimate of one sample (its first replicate) changes with the generation time and mutation
+    # rate: one panel per mutation rate, one curve per generation time, all from a single parse of the file.
+    # rawIterations: read_psmc_raw of psmcFiles[0], if already read
+    if rawIterations is None:
+        rawIterations = read_psmc_raw(psmcFiles[0])
+    scaledTimes, scaledSizes = rescale_psmc_grid(rawIterations, True, generationTimes, mutationRates,
+                                                 [psmcFiles[3]])
+
+    nColumns = int(numpy.ceil(numpy.sqrt(len(mutationRates))))
+    nRows = -(-len(mutationRates) // nColumns)
+    sensitivityFigure = mfigure.Figure(figsize=(3 * nColumns + 1, 2.5 * nRows + 1))
+    backend_agg.FigureCanvasAgg(sensitivityFigure)
+    panels = sensitivityFigure.subplots(nRows, nColumns, sharex=True, sharey=True, squeeze=False)
+    curveColors = mcm.viridis(numpy.linspace(0, 1, len(generationTimes)))
+    for i_rate, panel in enumerate(panels.flat):
+        if i_rate >= len(mutationRates) or not scaledTimes.shape[3]:
+            panel.set_visible(i_rate < len(mutationRates))
+            continue
+        for i_generation, generationTime in enumerate(generationTimes):
+            panel.step(scaledTimes[i_generation, i_rate, 0, 0], scaledSizes[i_generation, i_rate, 0, 0],
+                       color=curveColors[i_generation], linewidth=1.0, label="g = %g" % generationTime)
+        panel.set_xscale("log")
+        panel.set_title(r"$\mu$ = %.3g" % mutationRates[i_rate], fontsize="medium")
+        panel.grid(True)
+    for panel in panels.flat[max(0, len(mutationRates) - nColumns):len(mutationRates)]:
+        panel.set_xlabel("Years")
+        panel.xaxis.set_tick_params(labelbottom=True)
+    for panel in panels[:, 0]:
+        panel.set_ylabel("Effective population size")
+    if scaledTimes.shape[3]:
+        panels[0, 0].legend(loc=0, fontsize="small")
+    sensitivityFigure.suptitle("%s: generation time and mutation rate" % psmcFiles[4])
+    sensitivityFigure.tight_layout(rect=(0, 0, 1, 0.95))
+    return sensitivityFigure
+
+
+def project_psmc_curves(sampleCurves, gridSize=256, timeGrid=None):
+
+    # The step functions of many samples on one shared time grid (log-spaced over all the samples' times unless
+    # timeGrid is given): (timeGrid, samples x grid log10 sizes), NaN past the end of a sample's curve and for
+    # samples without one. sampleCurves: one (scaledTime, scaledSize) per sample, e.g. its first replicate
+    sampleCurves = [(numpy.asarray(scaledTime, dtype=numpy.float64), numpy.asarray(scaledSize, dtype=numpy.float64))
+                    for scaledTime, scaledSize in sampleCurves]
+    withCurve = [i_sample for i_sample, (scaledTime, _) in enumerate(sampleCurves) if len(scaledTime)]
+    if timeGrid is None:
+        finiteTimes = numpy.concatenate([sampleCurves[i_sample][0] for i_sample in withCurve] + [numpy.empty(0)])
+        finiteTimes = finiteTimes[numpy.isfinite(finiteTimes) & (finiteTimes > 0)]
+        timeGrid = numpy.geomspace(finiteTimes.min(), finiteTimes.max(), gridSize) if len(finiteTimes) else []
+    timeGrid = numpy.asarray(timeGrid, dtype=numpy.float64)
+
+    logSizes = numpy.full((len(sampleCurves), len(timeGrid)), numpy.nan)
+    if withCurve and len(timeGrid):
+        _, gridSizes = _resample_steps([sampleCurves[i_sample] for i_sample in withCurve], timeGrid=timeGrid)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            logSizes[withCurve] = numpy.log10(numpy.where(gridSizes > 0, gridSizes, numpy.nan))
+    return timeGrid, logSizes
+
+
+def curve_distance_matrix(logSizes, timeGrid=None, timeWindow=None, blockSize=256):
+
+    # Pairwise distances between the curves of project_psmc_curves: the root mean square difference of their
+    # log10 sizes over the grid times both curves reach, i.e. an L2 distance on log Ne with every grid time
+    # weighted alike (the default grid is log-spaced). NaN for pairs that share no grid time.
+    # timeWindow: (earliest, latest) time compared, in the units of timeGrid, to compare e.g. only the last
+    #   100 000 years; None for either bound leaves that side open
+    # blockSize: rows of the matrix computed at once. The squared differences are expanded into matrix
+    #   products, sum((a - b)^2) = sum(a^2) + sum(b^2) - 2 a.b over the shared grid times, so that a block costs
+    #   four products with the whole sample set and memory stays at blockSize x samples
+    logSizes = numpy.asarray(logSizes, dtype=numpy.float64)
+    if timeWindow is not None:
+        earliestTime, latestTime = timeWindow
+        inWindow = numpy.ones(len(timeGrid), dtype=bool)
+        if earliestTime is not None:
+            inWindow &= numpy.asarray(timeGrid) >= earliestTime
+        if latestTime is not None:
+            inWindow &= numpy.asarray(timeGrid) <= latestTime
+        logSizes = logSizes[:, inWindow]
+
+    isShared = ~numpy.isnan(logSizes)
+    sharedMask = isShared.astype(numpy.float64)
+    # centred on the mean of every grid time, so that the expansion does not lose precision to large sizes
+    columnMeans = numpy.nanmean(numpy.where(isShared.any(axis=0), logSizes, 0), axis=0) if len(logSizes) else 0
+    centredSizes = numpy.where(isShared, logSizes - columnMeans, 0)
+    squaredSizes = centredSizes ** 2
+
+    nSamples = len(logSizes)
+    curveDistances = numpy.empty((nSamples, nSamples))
+    for blockStart in range(0, nSamples, blockSize):
+        rowBlock = slice(blockStart, blockStart + blockSize)
+        sumOfSquares = (squaredSizes[rowBlock] @ sharedMask.T + sharedMask[rowBlock] @ squaredSizes.T
+                        - 2 * centredSizes[rowBlock] @ centredSizes.T)
+        nShared = sharedMask[rowBlock] @ sharedMask.T
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            curveDistances[rowBlock] = numpy.sqrt(numpy.maximum(sumOfSquares, 0) / nShared)
+    numpy.fill_diagonal(curveDistances, numpy.where(isShared.any(axis=1), 0, numpy.nan))
+    return curveDistances
+
+
+def psmc_distance_matrix(listOfOpt, yAsEffectiveSize=True, timeWindow=None, gridSize=256, sampleReplicates=None):
+
+    # curve_distance_matrix of the first replicate of every sample in listOfOpt, each scaled with its own
+    # generation time, mutation rate and bin size: (timeGrid, logSizes, curveDistances)
+    # sampleReplicates: parse_psmc_output of listOfOpt, if already parsed
+    if sampleReplicates is None:
+        sampleReplicates = parse_psmc_output(listOfOpt, yAsEffectiveSize)
+    timeGrid, logSizes = project_psmc_curves(
+        [replicates[0] if len(replicates) else ((), ()) for replicates in sampleReplicates], gridSize)
+    return timeGrid, logSizes, curve_distance_matrix(logSizes, timeGrid, timeWindow)
+
+
+def cluster_order(curveDistances):
+
+    # Leaf order of an average linkage (UPGMA) clustering of a distance matrix, so that similar samples end up
+    # next to each other in a heatmap. The two closest clusters are merged n - 1 times, their distances to the
+    # others updated as the size-weighted mean of both rows. NaN distances count as the largest one.
+    nSamples = len(curveDistances)
+    if nSamples < 3:
+        return list(range(nSamples))
+    clusterDistances = numpy.array(curveDistances, dtype=numpy.float64)
+    largestDistance = numpy.nanmax(clusterDistances) if not numpy.isnan(clusterDistances).all() else 0
+    clusterDistances[numpy.isnan(clusterDistances)] = largestDistance
+    numpy.fill_diagonal(clusterDistances, numpy.inf)
+    clusterSizes = numpy.ones(nSamples)
+    clusterLeaves = [[i_sample] for i_sample in range(nSamples)]
+
+    for _ in range(nSamples - 1):
+        i_cluster, j_cluster = divmod(int(numpy.argmin(clusterDistances)), nSamples)
+        mergedDistances = ((clusterSizes[i_cluster] * clusterDistances[i_cluster]
+                            + clusterSizes[j_cluster] * clusterDistances[j_cluster])
+                           / (clusterSizes[i_cluster] + clusterSizes[j_cluster]))
+        clusterDistances[i_cluster] = mergedDistances
+        clusterDistances[:, i_cluster] = mergedDistances
+        clusterDistances[i_cluster, i_cluster] = numpy.inf
+        clusterDistances[j_cluster] = numpy.inf
+        clusterDistances[:, j_cluster] = numpy.inf
+        clusterSizes[i_cluster] += clusterSizes[j_cluster]
+        clusterLeaves[i_cluster] += clusterLeaves[j_cluster]
+        clusterLeaves[j_cluster] = None
+    return next(leaves for leaves in clusterLeaves if leaves is not None)
+
 
-    psmcOptions = []
+def build_distance_figure(listOfOpt, curveDistances, leafOrder=None, maxLabels=60):
 
+    # Heatmap of a psmc_distance_matrix with the samples in cluster_order (or leafOrder), labelled with the
+    # sample names when there are at most maxLabels of them
+    if leafOrder is None:
+        leafOrder = cluster_order(curveDistances)
+    orderedDistances = numpy.asarray(curveDistances)[numpy.ix_(leafOrder, leafOrder)]
+
+    figureSize = min(14, 4 + 0.12 * len(leafOrder))
+    distanceFigure = mfigure.Figure(figsize=(figureSize + 1.5, figureSize))
+    backend_agg.FigureCanvasAgg(distanceFigure)
+    heatmapAxes = distanceFigure.add_subplot(111)
+    heatmapImage = heatmapAxes.imshow(numpy.ma.masked_invalid(orderedDistances), cmap="viridis",
+                                      interpolation="nearest")
+    distanceFigure.colorbar(heatmapImage, ax=heatmapAxes, label=r"RMS difference of $\log_{10} N_e$")
+    if len(leafOrder) <= maxLabels:
+        sampleNames = [listOfOpt[i_sample][4] for i_sample in leafOrder]
+        heatmapAxes.set_xticks(range(len(leafOrder)))
+        heatmapAxes.set_xticklabels(sampleNames, rotation=90, fontsize="small")
+        heatmapAxes.set_yticks(range(len(leafOrder)))
+        heatmapAxes.set_yticklabels(sampleNames, fontsize="small")
+    heatmapAxes.set_title("Distances between the PSMC curves of %d samples" % len(leafOrder))
+    distanceFigure.tight_layout()
+    return distanceFigure
+
+
+def export_distance_matrix(pathToMatrix, listOfOpt, curveDistances):
+
+    sampleNames = [psmcFiles[4] for psmcFiles in listOfOpt]
+    numpy.savetxt(pathToMatrix, curveDistances, delimiter="\t", fmt="%.6g", header="\t".join(sampleNames))
+    return pathToMatrix
+
+
+class PsmcFollower:
+    # Reads a psmc file that is still being written. poll() only reads the bytes appended since the previous
+    # poll and returns the rounds that were completed in them, so its cost does not depend on the file size:
+    # only the unfinished round is kept between polls. A file that shrinks (e.g. psmc was restarted) is read
+    # again from the start, replicates are then numbered from 0 again. Compressed files can not be followed.
+
+    def __init__(self, pathToPsmcFile):
+        if psmc_compression(pathToPsmcFile):
+            raise ValueError("%s is compressed, only the plain text files that psmc writes can be followed"
+                             % pathToPsmcFile)
+        self.pathToPsmcFile = pathToPsmcFile
+        self.psmcFile = open(pathToPsmcFile, 'rb')
+        self._restart()
+
+    def _restart(self):
+        self.psmcFile.seek(0)
+        self.nReplicates = 0
+        self.replicateIterations = []  # n_iterations of every replicate seen so far
+        self._pending = b""  # bytes from the start of the unfinished round (or line) on
+        self._scanFrom = 0  # where the lines of _pending that were not looked at yet start
+        self._roundStart = None  # (RD number, offset in _pending) of the unfinished round
+
+    def poll(self, latestOnly=False):
+        # Returns a list of (replicate, RD number, theta, t_k array, lambda_k array), one per round completed
+        # since the previous poll, in the order of the file
+        # latestOnly: only return (and decode) the last of those rounds for each replicate
+
+        if os.fstat(self.psmcFile.fileno()).st_size < self.psmcFile.tell():
+            self._restart()
+        newBytes = self.psmcFile.read()
+        if not newBytes:
+            return []
+        self._pending += newBytes
+        linesEnd = self._pending.rfind(b"\n") + 1  # only whole lines are looked at
+
+        completedRounds, roundBlocks = [], []
+        for indexLine in _INDEX_LINES.finditer(self._pending, self._scanFrom, linesEnd):
+            if indexLine.group(1) is not None:
+                self.nReplicates += 1
+                self.replicateIterations.append(int(indexLine.group(1)))
+                self._roundStart = None
+            elif indexLine.group(2) is not None:
+                self._roundStart = (int(indexLine.group(2)), indexLine.start()) if self.nReplicates else None
+            elif self._roundStart is not None:
+                roundIteration, roundOffset = self._roundStart
+                roundBlocks.append(self._pending[roundOffset:self._pending.find(b"\n", indexLine.start()) + 1])
+                completedRounds.append((self.nReplicates - 1, roundIteration))
+                self._roundStart = None
+
+        # drop everything before the unfinished round
+        keepFrom = self._roundStart[1] if self._roundStart is not None else linesEnd
+        self._pending = self._pending[keepFrom:]
+        self._scanFrom = linesEnd - keepFrom
+        if self._roundStart is not None:
+            self._roundStart = (self._roundStart[0], 0)
+
+        if latestOnly:
+            latestRounds = {i_replicate: i_round for i_round, (i_replicate, _) in enumerate(completedRounds)}
+            completedRounds = [completedRounds[i_round] for i_round in sorted(latestRounds.values())]
+            roundBlocks = [roundBlocks[i_round] for i_round in sorted(latestRounds.values())]
+
+        # all the rounds of this poll are decoded at once
+        estimatedThetas, timePoints, lambdaPoints = _read_iteration_blocks(roundBlocks)
+        return [(i_replicate, roundIteration, estimatedTheta, replicateTimes, replicateLambdas)
+                for (i_replicate, roundIteration), estimatedTheta, replicateTimes, replicateLambdas
+                in zip(completedRounds, estimatedThetas, timePoints, lambdaPoints)]
+
+    def close(self):
+        self.psmcFile.close()
+
+
+class PsmcFollowFigure:
+    # A plot of psmc files that are still being written: one curve per replicate, showing its latest
+    # complete round. update() polls every file and only changes the curves of replicates with a new round.
+
+    def __init__(self, listOfOpt, yAsEffectiveSize, transparency=0.1, isXLogScale=True, isYLogScale=False):
+
+        self.listOfOpt = listOfOpt
+        self.yAsEffectiveSize = yAsEffectiveSize
+        self.transparency = transparency
+        self.sampleKey = None  # never reused for a normal plot
+        self.followers = []
+        try:
+            for psmcFiles in listOfOpt:
+                self.followers.append(PsmcFollower(psmcFiles[0]))
+        except Exception:
+            self.close()
+            raise
+        self.replicateLines = {}  # (sample, replicate) -> Line2D
+
+        self.figure = mfigure.Figure()
+        backend_agg.FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(111)
+        self.axes.set_xscale("log" if isXLogScale else "linear")
+        self.axes.set_yscale("log" if isYLogScale else "linear")
+        self.axes.grid(True)
+        self.figure.suptitle("PSMC estimate, following %d file(s)" % len(listOfOpt))
+        if yAsEffectiveSize:
+            self.axes.set_xlabel("Years")
+            self.axes.set_ylabel("Effective population size")
+        else:
+            self.axes.set_xlabel(r'Time (scaled in units of 2$\mu$T)')
+            self.axes.set_ylabel("Population size\n(scaled in units of $4\\mu N_e\\ x\\ 10^3$)")
+
+    def update(self):
+        # Returns the (sample, replicate, RD number) of every curve that changed
+
+        changedCurves = []
+        for i_sample, (psmcFiles, psmcFollower) in enumerate(zip(self.listOfOpt, self.followers)):
+            for i_replicate, iteration, estimatedTheta, timePoints, lambdaPoints in psmcFollower.poll(latestOnly=True):
+                scaledTime, scaledSize = _scale_psmc_points(timePoints, lambdaPoints, estimatedTheta,
+                                                            psmcFiles, self.yAsEffectiveSize)
+                replicateLine = self.replicateLines.get((i_sample, i_replicate))
+                if replicateLine is None:
+                    # the first replicate is the estimate on the real data, the others are bootstraps
+                    replicateLine, = self.axes.step([], [], color=psmcFiles[5],
+                                                    linewidth=2.0 if i_replicate == 0 else 1.0,
+                                                    alpha=1.0 if i_replicate == 0 else self.transparency,
+                                                    label=psmcFiles[4] if i_replicate == 0 else None)
+                    self.replicateLines[(i_sample, i_replicate)] = replicateLine
+                    if i_replicate == 0:
+                        self.axes.legend(loc=0)
+                replicateLine.set_data(scaledTime, scaledSize)
+                changedCurves.append((i_sample, i_replicate, iteration))
+
+        if changedCurves:
+            _, i_replicate, iteration = changedCurves[-1]
+            self.axes.set_title("Latest: replicate %d, round %d" % (i_replicate, iteration))
+            self.axes.relim()
+            self.axes.autoscale_view()
+        return changedCurves
+
+    def close(self):
+        for psmcFollower in self.followers:
+            psmcFollower.close()
+
+
+def follow_psmc(listOfOpt, yAsEffectiveSize, pathToPlot, pollInterval=10.0, idleTimeout=None,
+                transparency=0.1, reportProgress=_ignore_progress):
+
+    # Rewrites the plot pathToPlot whenever a round is completed in one of the followed files, until there
+    # has been no new round for idleTimeout seconds (forever if None) or the process is interrupted
+    followFigure = PsmcFollowFigure(listOfOpt, yAsEffectiveSize, transparency)
+    lastChange = time.monotonic()
+    try:
+        while idleTimeout is None or time.monotonic() - lastChange < idleTimeout:
+            changedCurves = followFigure.update()
+            if changedCurves:
+                lastChange = time.monotonic()
+                followFigure.figure.savefig(pathToPlot)
+                reportProgress("%s: %d curve(s) updated" % (pathToPlot, len(changedCurves)))
+            time.sleep(pollInterval)
+    finally:
+        followFigure.close()
+    return pathToPlot
+
+
+# Besides one row per psmc file (path, generation time, mutation rate, bin size, sample name and an optional
+# colour), a parameter file can list many files at once:
+#   - the path of a row can be a glob pattern (runs/*.psmc.gz), which adds the row for every matching file, in
+#     sorted order. "{file}" in the sample name is replaced by the name of the file without its extensions,
+#     and is appended to the name when the pattern matches several files and the name does not have it.
+#   - "@defaults <directory> <generationTime> <mutationRate> <binSize>" gives the parameters of the files
+#     inside that directory (the closest one wins), whose rows then only need the path and optionally the
+#     name (default "{file}") and colour.
+# Rows that repeat an earlier one (same file, parameters and name) are left out.
+_MANIFEST_DEFAULTS = "@defaults"
+
+
+def _directory_defaults(pathToPsmcFile, directoryDefaults):
+    # the @defaults of the closest directory containing pathToPsmcFile
+
+    directory = os.path.dirname(os.path.abspath(pathToPsmcFile))
+    while directory not in directoryDefaults:
+        parentDirectory = os.path.dirname(directory)
+        if parentDirectory == directory:
+            raise ValueError("%s has no generation time, mutation rate and bin size, and none of its directories "
+                             "has %s" % (pathToPsmcFile, _MANIFEST_DEFAULTS))
+        directory = parentDirectory
+    return directoryDefaults[directory]
+
+
+def readPsmcOptions(pathToOptionsFile):
+
+    manifestRows, directoryDefaults = [], {}
     with open(pathToOptionsFile, 'r') as psmcOptionsFile:
         for line in psmcOptionsFile:
-            if line[:1] != '#':  # if line doesnt start with a '#'
-                # create a list of options from parameter file
-                optTokens = regex.findall(r'[^\s\t\"]+', line)
-                # could do it all in one line but this has better readability
-                pathToPsmcFile = optTokens[0]
-                generationTime = float(optTokens[1])
-                mutationRate = float(optTokens[2])
-                binSize = float(optTokens[3])
-                sampleName = optTokens[4]
-                if len(optTokens) == 6:
-                    lineColor = optTokens[5]
-                else:
-                    # get random color
-                    lineColor = (rnd(), rnd(), rnd())
-
-                psmcOptions.append((pathToPsmcFile,
-                                    generationTime,
-                                    mutationRate,
-                                    binSize,
-                                    sampleName,
-                                    lineColor))
+            if line[:1] == '#':  # comment
+                continue
+            # the tokens of regex.findall(r'[^\s\t\"]+', line), without a regular expression per line
+            optTokens = line.replace('"', ' ').split()
+            if not optTokens:
+                continue
+            if optTokens[0] == _MANIFEST_DEFAULTS:
+                directoryDefaults[os.path.abspath(optTokens[1])] = tuple(map(float, optTokens[2:5]))
+            else:
+                manifestRows.append(optTokens)
+
+    psmcOptions, listedRows, absolutePaths = [], set(), {}
+    for optTokens in manifestRows:
+        try:
+            rowParameters = tuple(map(float, optTokens[1:4])) if len(optTokens) >= 4 else None
+        except ValueError:
+            rowParameters = None
+        nameAndColor = optTokens[1:] if rowParameters is None else optTokens[4:]
+        sampleName = nameAndColor[0] if nameAndColor else "{file}"
+
+        # a file that exists is taken as it is, even with glob characters in its name
+        if ("*" in optTokens[0] or "?" in optTokens[0] or "[" in optTokens[0]) and not os.path.exists(optTokens[0]):
+            matchingPaths = sorted(glob.glob(optTokens[0]))
+            if not matchingPaths:
+                raise FileNotFoundError("no psmc file matches %s" % optTokens[0])
+            if len(matchingPaths) > 1 and "{file}" not in sampleName:
+                sampleName += "_{file}"
+        else:
+            matchingPaths = [optTokens[0]]
+
+        for pathToPsmcFile in matchingPaths:
+            generationTime, mutationRate, binSize = rowParameters or _directory_defaults(pathToPsmcFile,
+                                                                                         directoryDefaults)
+            fileSampleName = sampleName
+            if "{file}" in sampleName:
+                fileSampleName = sampleName.replace("{file}", os.path.basename(_psmc_file_stem(pathToPsmcFile)))
+
+            if pathToPsmcFile not in absolutePaths:
+                absolutePaths[pathToPsmcFile] = os.path.abspath(pathToPsmcFile)
+            rowKey = (absolutePaths[pathToPsmcFile], generationTime, mutationRate, binSize, fileSampleName)
+            if rowKey in listedRows:
+                continue
+            listedRows.add(rowKey)
+
+            if len(nameAndColor) == 2:
+                lineColor = nameAndColor[1]
+            else:
+                # get random color
+                lineColor = (rnd(), rnd(), rnd())
+
+            psmcOptions.append((pathToPsmcFile,
+                                generationTime,
+                                mutationRate,
+                                binSize,
+                                fileSampleName,
+                                lineColor))
 
     return psmcOptions
 
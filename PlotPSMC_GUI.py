@@ -1,8 +1,10 @@
 import tkinter
 from tkinter import messagebox
-from PIL import Image, ImageTk  # PIL is now called pillow for installation purposes
 import PlotPSMC
 import traceback
+import threading
+import queue
+import sys
 from pathlib import Path
 
 
@@ -86,8 +88,9 @@ class PlotPSMCApp(tkinter.Tk):
         savePlotNameRow = 15
         isLogScaleRow = 16
         plotLGMRow = 17
-        buttonPlot = plotRowSpan = 18
-        logReportRow = 19
+        followRow = 18
+        buttonPlot = plotRowSpan = 19
+        logReportRow = 20
 
         labelColumns = 0
         entryColumns = 1
@@ -172,6 +175,12 @@ class PlotPSMCApp(tkinter.Tk):
             bg=plottingOptionsColor,
             activebackground=activePltOptCol
         )
+        self.exportButton = tkinter.Button(
+            self, text="Export plot",
+            command=self.on_button_export,
+            bg=plottingOptionsColor,
+            activebackground=activePltOptCol
+        )
 
         self.isLogScaleLabel = tkinter.Label(self, text="Plot in log scale?", bg=plottingOptionsColor)
         self.isXLogScale = tkinter.BooleanVar()
@@ -219,6 +228,21 @@ class PlotPSMCApp(tkinter.Tk):
         )
         self.plotLGMButton.select()
 
+        self.followLabel = tkinter.Label(self, text="Follow running psmc?", bg=plottingOptionsColor)
+        self.doFollow = tkinter.BooleanVar()
+        self.followButton = tkinter.Checkbutton(
+            self, variable=self.doFollow,
+            onvalue=True,
+            offvalue=False,
+            anchor="c",
+            fg="black",
+            bg=bgWindowColor,
+            justify="center",
+            highlightthickness=0,
+            activebackground=plottingOptionsColor
+        )
+        self.followButton.deselect()
+
         self.logReportString = tkinter.StringVar()
         self.logReportLabel = tkinter.Label(
             self, textvariable=self.logReportString,
@@ -416,7 +440,13 @@ class PlotPSMCApp(tkinter.Tk):
         self.plotButton.grid(
             row=buttonPlot,
             column=0,
-            columnspan=2,
+            pady=self.paddingYopt
+        )
+
+        #  export plot button
+        self.exportButton.grid(
+            row=buttonPlot,
+            column=1,
             pady=self.paddingYopt
         )
 
@@ -458,6 +488,21 @@ class PlotPSMCApp(tkinter.Tk):
             pady=self.paddingYopt
         )
 
+        # follow psmc files that are still being written check button
+        self.followLabel.grid(
+            row=followRow,
+            column=labelColumns,
+            padx=self.paddingXopt,
+            pady=self.paddingYopt,
+            sticky=self.stickTo
+        )
+        self.followButton.grid(
+            row=followRow,
+            column=entryColumns,
+            padx=self.paddingXopt,
+            pady=self.paddingYopt
+        )
+
         self.logReportLabel.grid(
             row=logReportRow,
             column=labelColumns,
@@ -469,10 +514,12 @@ class PlotPSMCApp(tkinter.Tk):
 
         self.center_window()
 
-        photo = ImageTk.PhotoImage(Image.open("blankPlot.png"))
+        # an empty image of the plot size keeps the layout, blankPlot.png is only decoded once the window is shown
+        photo = tkinter.PhotoImage(width=640, height=480)
         self.plotInGrid = tkinter.Label(self, image=photo)
         self.plotInGrid.image = photo
         self.plotInGrid.grid(row=1, column=2, rowspan=plotRowSpan, padx=5, pady=5)
+        self.after_idle(self.show_blank_plot)
 
         # on client exit
         self.protocol("WM_DELETE_WINDOW", self.client_exit)
@@ -481,6 +528,19 @@ class PlotPSMCApp(tkinter.Tk):
         # create window variable to hold plot
         self.figWindow = None
 
+        # plots are made on a worker thread, clicks that arrive meanwhile are collapsed into pendingPlotRequest
+        # the last previewed figure is kept for "Export plot", nothing is written to ./Plots before that,
+        # and for replotting when only axis options change
+        self.psmcFigure = None
+        self.plotWorker = None
+        self.pendingPlotRequest = None
+        self.plotMessages = queue.Queue()
+        # with "Follow running psmc?", the files are polled every followInterval ms on the same worker thread
+        # and only the curves of replicates with a new round are redrawn
+        self.followFigure = None
+        self.followFiguresToClose = []
+        self.followInterval = 2000
+
         # error reporting
         self.report_callback_exception = self.show_error
 
@@ -500,7 +560,16 @@ class PlotPSMCApp(tkinter.Tk):
         else:
             self.logReportString.set("Please provide a valid path to a PSMC file or import a parameter file.")
 
+    def show_blank_plot(self):
+        # Tk reads PNG files itself, PIL is only imported when a plot is made
+        if self.psmcFigure is None:
+            photo = tkinter.PhotoImage(file="blankPlot.png")
+            self.plotInGrid.configure(image=photo)
+            self.plotInGrid.image = photo
+
     def on_button_plot_externalWindow(self):
+        from PIL import Image, ImageTk
+
         PlotPSMC.plotPsmc(self.psmcOptions, yAsEffectiveSize=True,
                           xmin=float(self.xminEntry.get()),
                           xmax=float(self.xmaxEntry.get()),
@@ -521,26 +590,162 @@ class PlotPSMCApp(tkinter.Tk):
 
     def on_button_plot(self):
         if self.psmcOptions:
-            PlotPSMC.plotPsmc(self.psmcOptions, yAsEffectiveSize=True,
-                              xmin=float(self.xminEntry.get()),
-                              xmax=float(self.xmaxEntry.get()),
-                              ymin=float(self.yminEntry.get()),
-                              ymax=float(self.ymaxEntry.get()),
-                              transparency=float(self.transparencyEntry.get()),
-                              isXLogScale=self.isXLogScale.get(),
-                              isYLogScale=self.isYLogScale.get(),
-                              showLGM=self.doPlotLGM.get(),
-                              savePlotWithName=self.savePlotNameEntry.get())
-            myImage = ImageTk.PhotoImage(Image.open("./Plots/" + self.savePlotNameEntry.get() + ".png"))
-            self.plotInGrid.configure(image=myImage)
-            self.plotInGrid.image = myImage
-            self.logReportString.set(
-                "Plotted image from the following PSMC entries: \n" + self.psmcOptions.__str__() +
-                ".\n" + "Saved plot as " + self.savePlotNameEntry.get() + ".png."
-            )
+            # read every option here, Tk widgets must only be used from the main thread
+            plotRequest = dict(listOfOpt=list(self.psmcOptions), yAsEffectiveSize=True,
+                               axisOptions=dict(xmin=float(self.xminEntry.get()),
+                                                xmax=float(self.xmaxEntry.get()),
+                                                ymin=float(self.yminEntry.get()),
+                                                ymax=float(self.ymaxEntry.get()),
+                                                transparency=float(self.transparencyEntry.get()),
+                                                isXLogScale=self.isXLogScale.get(),
+                                                isYLogScale=self.isYLogScale.get(),
+                                                showLGM=self.doPlotLGM.get()))
+            if self.doFollow.get():
+                self.start_following(plotRequest)
+            elif self.plotWorker is not None:
+                # only the latest request is plotted once the current one is done
+                self.pendingPlotRequest = plotRequest
+                self.logReportString.set("A plot is being made, the latest options will be plotted next.")
+            else:
+                self.start_plot_worker(plotRequest)
         else:
             self.logReportString.set("There are no PSMC entries available, nothing to plot.")
 
+    def start_plot_worker(self, plotRequest):
+        self.plotWorker = threading.Thread(target=self.plot_in_background, args=(plotRequest, self.psmcFigure),
+                                           daemon=True)
+        self.plotWorker.start()
+        self.after(50, self.poll_plot_worker)
+
+    def start_following(self, plotRequest):
+        self.stop_following()
+        axisOptions = plotRequest["axisOptions"]
+        try:
+            self.followFigure = PlotPSMC.PsmcFollowFigure(plotRequest["listOfOpt"], plotRequest["yAsEffectiveSize"],
+                                                          axisOptions["transparency"], axisOptions["isXLogScale"],
+                                                          axisOptions["isYLogScale"])
+        except (OSError, ValueError) as followError:
+            self.logReportString.set("Can not follow the PSMC entries: %s" % followError)
+            return
+        self.logReportString.set("Following the PSMC entries, the plot is updated as psmc completes rounds.")
+        self.poll_follow()
+
+    def stop_following(self):
+        if self.followFigure is not None:
+            # the files are closed once the worker thread no longer reads them
+            self.followFiguresToClose.append(self.followFigure)
+            self.followFigure = None
+        self.close_stopped_follow_figures()
+
+    def close_stopped_follow_figures(self):
+        if self.plotWorker is None:
+            for followFigure in self.followFiguresToClose:
+                followFigure.close()
+            self.followFiguresToClose = []
+
+    def poll_follow(self):
+        if self.followFigure is None:
+            return
+        if not self.doFollow.get():
+            self.stop_following()
+            return
+        if self.plotWorker is None:
+            self.plotWorker = threading.Thread(target=self.follow_in_background, args=(self.followFigure,),
+                                               daemon=True)
+            self.plotWorker.start()
+            self.after(50, self.poll_plot_worker)
+        self.after(self.followInterval, self.poll_follow)
+
+    def follow_in_background(self, followFigure):
+        # runs on the worker thread, only reads what psmc appended since the previous poll
+        try:
+            plotReport = PlotPSMC.PlotReport()
+            with plotReport.timed("follow") as followStage:
+                followStage["curves"] = len(followFigure.update())
+            if not followStage["curves"]:
+                self.plotMessages.put(("idle", None))
+                return
+            plotImage = self.render_preview(followFigure.figure, plotReport)
+            self.plotMessages.put(("done", (plotImage, followFigure, dict(listOfOpt=followFigure.listOfOpt),
+                                            plotReport)))
+        except Exception:
+            self.plotMessages.put(("error", sys.exc_info()))
+
+    @staticmethod
+    def render_preview(plotFigure, plotReport):
+        # preview straight from the Agg canvas, without encoding/decoding a PNG
+        from PIL import Image  # PIL is now called pillow for installation purposes
+        plotCanvas = plotFigure.canvas
+        with plotReport.timed("draw"):
+            plotCanvas.draw()
+        with plotReport.timed("preview"):
+            return Image.frombuffer("RGBA", plotCanvas.get_width_height(),
+                                    bytes(plotCanvas.buffer_rgba()), "raw", "RGBA", 0, 1)
+
+    def plot_in_background(self, plotRequest, psmcFigure):
+        # runs on the worker thread, results and progress go back to the main loop through plotMessages
+        try:
+            plotReport = PlotPSMC.PlotReport()
+            # the previous figure is reused, without reading any file again, if only axis options changed and
+            # none of the psmc files was rewritten since it was made
+            sampleKey = PlotPSMC.PsmcFigure.sample_key(plotRequest["listOfOpt"], plotRequest["yAsEffectiveSize"])
+            if (psmcFigure is None or psmcFigure.sampleKey != sampleKey
+                    or psmcFigure.fileFingerprints != PlotPSMC.psmc_file_fingerprints(plotRequest["listOfOpt"])):
+                psmcFigure = PlotPSMC.PsmcFigure(
+                    plotRequest["listOfOpt"], plotRequest["yAsEffectiveSize"],
+                    reportProgress=lambda message: self.plotMessages.put(("progress", message)),
+                    report=plotReport)
+            with plotReport.timed("axes"):
+                plotFigure = psmcFigure.set_options(**plotRequest["axisOptions"])
+            plotImage = self.render_preview(plotFigure, plotReport)
+            self.plotMessages.put(("done", (plotImage, psmcFigure, plotRequest, plotReport)))
+        except Exception:
+            self.plotMessages.put(("error", sys.exc_info()))
+
+    def poll_plot_worker(self):
+        while True:
+            try:
+                messageType, message = self.plotMessages.get_nowait()
+            except queue.Empty:
+                break
+
+            if messageType == "progress":
+                self.logReportString.set(message)
+                continue
+
+            self.plotWorker = None
+            if messageType == "done":
+                from PIL import ImageTk
+                plotImage, self.psmcFigure, plotRequest, plotReport = message
+                myImage = ImageTk.PhotoImage(plotImage)
+                self.plotInGrid.configure(image=myImage)
+                self.plotInGrid.image = myImage
+                self.logReportString.set(
+                    "Plotted image from the following PSMC entries: \n" + plotRequest["listOfOpt"].__str__() +
+                    ".\n" + "Use \"Export plot\" to save it.\n" + plotReport.format_totals()
+                )
+            elif messageType == "error":
+                self.show_error(*message)
+            self.close_stopped_follow_figures()
+
+            if self.pendingPlotRequest is not None:
+                plotRequest, self.pendingPlotRequest = self.pendingPlotRequest, None
+                self.start_plot_worker(plotRequest)
+            return
+
+        self.after(50, self.poll_plot_worker)
+
+    def on_button_export(self):
+        if self.plotWorker is not None:
+            self.logReportString.set("A plot is being made, please export it once it is shown.")
+        elif self.psmcFigure is not None:
+            Path("./Plots").mkdir(exist_ok=True)
+            plotName = self.savePlotNameEntry.get()
+            self.psmcFigure.figure.savefig("./Plots/" + plotName + ".png")
+            self.logReportString.set("Saved plot as " + plotName + ".png.")
+        else:
+            self.logReportString.set("There is no plot to export yet, plot your PSMC entries first.")
+
     def on_button_clear(self):
         self.psmcOptions = []
         self.logReportString.set("All PSMC entries have been cleared.")
@@ -0,0 +1,46 @@
+import argparse
+import os
+import sys
+
+import PlotPSMC
+
+
+def parse_arguments(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Convert psmc files into binary archives that PlotPSMC reads much faster. "
+                    "An archive can be used anywhere a psmc file is expected, e.g. in a parameter file.")
+    parser.add_argument("psmcFiles", nargs="+",
+                        help="text psmc files, which may be compressed (.gz, .bgz, .zst), "
+                             "each gets a .psmcarc file next to it")
+    parser.add_argument("--outdir", default=None, help="write the archives to this directory instead")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    args = parse_arguments(argv)
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    nFailed = 0
+    for pathToPsmcFile in args.psmcFiles:
+        pathToArchive = None
+        if args.outdir:
+            pathToArchive = os.path.join(args.outdir,
+                                         PlotPSMC._psmc_file_stem(os.path.basename(pathToPsmcFile)) + ".psmcarc")
+        try:
+            pathToArchive = PlotPSMC.convert_psmc_to_archive(pathToPsmcFile, pathToArchive)
+        except (OSError, ValueError) as conversionError:
+            nFailed += 1
+            print("%s failed: %s" % (pathToPsmcFile, conversionError), file=sys.stderr)
+            continue
+        print("%s -> %s (%.1f MB -> %.1f MB)" % (pathToPsmcFile, pathToArchive,
+                                                 os.path.getsize(pathToPsmcFile) / 1e6,
+                                                 os.path.getsize(pathToArchive) / 1e6))
+
+    return 1 if nFailed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import matplotlib
+matplotlib.use("Agg")  # headless, must happen before anything imports pyplot
+
+import argparse
+import concurrent.futures
+import os
+import sys
+
+import PlotPSMC
+
+
+def render_parameter_file(pathToOptionsFile, plotOptions, profile=False, convergence=False, animate=False,
+                          generationTimes=None, mutationRates=None, exportFormats=None, distances=False,
+                          distanceWindow=None):
+    # one figure per parameter file, named after it, returned with the timings of the plot
+    # convergence, animate: also write <name>_convergence.png and <name>_rounds.gif, from one read of the rounds
+    # generationTimes, mutationRates: also write <name>_<sample>_sensitivity.png for every sample
+    # exportFormats: (format, dpi) pairs to write instead of the default png, see PlotPSMC.export_psmc_figure
+    # distances: also write <name>_distances.tsv and its clustered heatmap <name>_clusters.png, comparing the
+    #   samples' curves over distanceWindow, (earliest, latest) in years, or all of them
+    psmcOptions = PlotPSMC.readPsmcOptions(pathToOptionsFile)
+    plotName = os.path.splitext(os.path.basename(pathToOptionsFile))[0]
+    plotReport = PlotPSMC.PlotReport()
+    profilePath = os.path.join(plotOptions["plotDirectory"], plotName + ".pstats") if profile else None
+    if profilePath is not None:
+        os.makedirs(plotOptions["plotDirectory"], exist_ok=True)
+    if exportFormats:
+        # the parameter files are already rendered in parallel, so the formats are written one after the other
+        pathToPlot = ", ".join(pathToExport for pathToExport, _ in PlotPSMC.export_psmc_plot(
+            psmcOptions, exportFormats=exportFormats, nExportWorkers=1, savePlotWithName=plotName,
+            report=plotReport, **plotOptions))
+    else:
+        pathToPlot = PlotPSMC.plotPsmc(psmcOptions, savePlotWithName=plotName, report=plotReport,
+                                       profilePath=profilePath, **plotOptions)
+
+    if convergence or animate:
+        with plotReport.timed("rounds"):
+            sampleRounds = PlotPSMC.read_each_file_once(psmcOptions, PlotPSMC.read_psmc_rounds)
+    if convergence:
+        with plotReport.timed("convergence"):
+            PlotPSMC.build_convergence_figure(psmcOptions, sampleRounds).savefig(
+                os.path.join(plotOptions["plotDirectory"], plotName + "_convergence.png"))
+    if animate:
+        with plotReport.timed("animation"):
+            PlotPSMC.animate_psmc_rounds(psmcOptions, plotOptions["yAsEffectiveSize"],
+                                         os.path.join(plotOptions["plotDirectory"], plotName + "_rounds.gif"),
+                                         sampleRounds, transparency=plotOptions["transparency"])
+    if generationTimes or mutationRates:
+        for psmcFiles, rawIterations in zip(psmcOptions,
+                                            PlotPSMC.read_each_file_once(psmcOptions, PlotPSMC.read_psmc_raw)):
+            with plotReport.timed("sensitivity", psmcFiles[4]):
+                PlotPSMC.build_sensitivity_figure(psmcFiles, generationTimes or [psmcFiles[1]],
+                                                  mutationRates or [psmcFiles[2]], rawIterations).savefig(
+                    os.path.join(plotOptions["plotDirectory"], "%s_%s_sensitivity.png" % (plotName, psmcFiles[4])))
+    if distances:
+        with plotReport.timed("distances", samples=len(psmcOptions)):
+            _, _, curveDistances = PlotPSMC.psmc_distance_matrix(psmcOptions, timeWindow=distanceWindow)
+            PlotPSMC.export_distance_matrix(os.path.join(plotOptions["plotDirectory"], plotName + "_distances.tsv"),
+                                            psmcOptions, curveDistances)
+        with plotReport.timed("clusters"):
+            PlotPSMC.build_distance_figure(psmcOptions, curveDistances).savefig(
+                os.path.join(plotOptions["plotDirectory"], plotName + "_clusters.png"))
+    return pathToPlot, str(plotReport)
+
+
+def parse_export_format(formatArgument):
+    # "png:300" -> ("png", 300), "svg" -> ("svg", None)
+    exportFormat, _, dpi = formatArgument.partition(":")
+    try:
+        return exportFormat.lower(), int(dpi) if dpi else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected FORMAT or FORMAT:DPI, e.g. png:300, not %r" % formatArgument)
+
+
+def parse_arguments(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Render PSMC plots from one or more parameter files without opening a window.")
+    parser.add_argument("parameterFiles", nargs="+",
+                        help="parameter files in the readPsmcOptions format (glob patterns and @defaults rows "
+                             "included), one plot is made for each")
+    parser.add_argument("--scaled", action="store_true",
+                        help="plot in units of 2muT and 4muNe instead of years and effective population size")
+    parser.add_argument("--xmin", type=float, default=0)
+    parser.add_argument("--xmax", type=float, default=0)
+    parser.add_argument("--ymin", type=float, default=0)
+    parser.add_argument("--ymax", type=float, default=0)
+    parser.add_argument("--transparency", type=float, default=0.1, help="alpha of the bootstrap curves")
+    parser.add_argument("--bootstrap-style", choices=("collection", "steps", "summary", "density"),
+                        default="collection",
+                        help="how the bootstrap replicates are drawn, density scales best to thousands of them")
+    parser.add_argument("--linear-x", action="store_true", help="do not use a log scale for the x axis")
+    parser.add_argument("--log-y", action="store_true", help="use a log scale for the y axis")
+    parser.add_argument("--lgm", action="store_true", help="show the Last Glacial Maximum")
+    parser.add_argument("--outdir", default="./Plots", help="directory the plots are written to")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of plots rendered at once")
+    parser.add_argument("--convergence", action="store_true",
+                        help="also plot the log-likelihood, Q, theta and curve changes of every round of iterations")
+    parser.add_argument("--animate", action="store_true",
+                        help="also write a .gif with one frame per round of iterations")
+    parser.add_argument("--generation-times", type=float, nargs="+", metavar="YEARS", default=None,
+                        help="also plot every sample rescaled with each of these generation times")
+    parser.add_argument("--mutation-rates", type=float, nargs="+", metavar="MU", default=None,
+                        help="also plot every sample rescaled with each of these mutation rates, one panel each")
+    parser.add_argument("--formats", type=parse_export_format, nargs="+", metavar="FORMAT[:DPI]", default=None,
+                        help="write the plot in each of these formats from one build of the figure, "
+                             "e.g. --formats png:100 png:300 svg pdf")
+    parser.add_argument("--distances", action="store_true",
+                        help="also write the pairwise distances between the samples' curves (RMS difference of "
+                             "log10 Ne) and a heatmap of them with similar samples clustered together")
+    parser.add_argument("--distance-window", type=float, nargs=2, metavar=("EARLIEST", "LATEST"), default=None,
+                        help="with --distances, only compare the curves between these two times (years ago)")
+    parser.add_argument("--follow", type=float, metavar="SECONDS", default=None,
+                        help="keep following the psmc files of a single parameter file while psmc writes them, "
+                             "checking every SECONDS and rewriting the plot when a round is complete")
+    parser.add_argument("--idle-timeout", type=float, metavar="SECONDS", default=None,
+                        help="with --follow, stop after SECONDS without a new round (default: until interrupted)")
+    parser.add_argument("--report", action="store_true", help="print the time taken by every stage of each plot")
+    parser.add_argument("--profile", action="store_true",
+                        help="write a cProfile/pstats file next to each plot, named after it")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    args = parse_arguments(argv)
+    plotOptions = dict(yAsEffectiveSize=not args.scaled,
+                       xmin=args.xmin, xmax=args.xmax,
+                       ymin=args.ymin, ymax=args.ymax,
+                       transparency=args.transparency,
+                       isXLogScale=not args.linear_x,
+                       isYLogScale=args.log_y,
+                       showLGM=args.lgm,
+                       bootstrapStyle=args.bootstrap_style,
+                       plotDirectory=args.outdir)
+
+    if args.follow is not None:
+        if len(args.parameterFiles) != 1:
+            print("--follow takes a single parameter file", file=sys.stderr)
+            return 1
+        plotName = os.path.splitext(os.path.basename(args.parameterFiles[0]))[0]
+        os.makedirs(args.outdir, exist_ok=True)
+        try:
+            PlotPSMC.follow_psmc(PlotPSMC.readPsmcOptions(args.parameterFiles[0]), plotOptions["yAsEffectiveSize"],
+                                 os.path.join(args.outdir, plotName + ".png"), args.follow, args.idle_timeout,
+                                 args.transparency, reportProgress=print)
+        except KeyboardInterrupt:
+            pass
+        except (OSError, ValueError) as followError:
+            print(followError, file=sys.stderr)
+            return 1
+        return 0
+
+    nFailed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs)) as renderPool:
+        renderJobs = {renderPool.submit(render_parameter_file, pathToOptionsFile, plotOptions, args.profile,
+                                        args.convergence, args.animate, args.generation_times,
+                                        args.mutation_rates, args.formats, args.distances,
+                                        args.distance_window):
+                      pathToOptionsFile for pathToOptionsFile in args.parameterFiles}
+        for renderJob in concurrent.futures.as_completed(renderJobs):
+            try:
+                pathToPlot, plotReport = renderJob.result()
+                print("%s -> %s" % (renderJobs[renderJob], pathToPlot))
+                if args.report:
+                    print(plotReport)
+            except Exception as renderError:
+                nFailed += 1
+                print("%s failed: %s" % (renderJobs[renderJob], renderError), file=sys.stderr)
+
+    return 1 if nFailed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,541 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import gzip
+import struct
+import zlib
+
+import numpy
+
+import PlotPSMC
+
+
+PSMC_HEADER = """CC
+CC\tBrief Description of the file format:
+CC\t  CC  comments
+CC\t  MM  useful-messages
+CC\t  RD  round-of-iterations
+CC\t  LL  \\log[P(sequence)]
+CC\t  QD  Q-before-opt Q-after-opt
+CC\t  TR  \\theta_0 \\rho_0
+CC\t  RS  k t_k \\lambda_k \\pi_k \\sum_{l\\not=k}A_{kl} A_{kk}
+CC\t  DC  begin end best-k t_k+\\Delta_k max-prob
+CC
+MM\tVersion: 0.6.5-r67
+MM\tpattern:%(pattern)s, n:%(n)d, n_free_lambdas:%(nFree)d
+MM\tn_iterations:%(nIterations)d, skip:1, max_t:%(maxT)g, theta/rho:5
+MM\tis_decoding:0
+MM\tn_seqs:%(nSeqs)d, sum_L:%(sumL)d, sum_n:%(sumN)d
+"""
+
+
+def write_synthetic_psmc(pathToPsmcFile, nReplicates=100, nIterations=25, nIntervals=64, seed=0):
+    # A combined bootstrap file of nReplicates psmc runs, each with rounds RD 0 .. nIterations of nIntervals
+    # atomic intervals, laid out as described in the CC header. Every interval is a free lambda (pattern
+    # "nIntervals*1"), t_k follows psmc's 0.1*exp(k/n*log(1+10*max_t))-0.1 and lambda_k, theta and max_t
+    # take a small random walk between rounds, so the parsers see the same kind of text as in real runs.
+    randomState = numpy.random.RandomState(seed)
+    intervalIndex = numpy.arange(nIntervals)
+    with open(pathToPsmcFile, 'w') as psmcFile:
+        for _ in range(nReplicates):
+            maxT = 15.0
+            theta = 0.035 * randomState.lognormal(0, 0.05)
+            rho = theta / 5
+            lambdas = numpy.ones(nIntervals)
+            psmcFile.write(PSMC_HEADER % dict(pattern="%d*1" % nIntervals, n=nIntervals - 1, nFree=nIntervals,
+                                              nIterations=nIterations, maxT=maxT,
+                                              nSeqs=913, sumL=25863898, sumN=892255))
+            for iteration in range(nIterations + 1):
+                if iteration > 0:
+                    psmcFile.write("IT\t%d\n" % randomState.randint(1000, 10000))
+                    maxT *= randomState.lognormal(0.02, 0.01)
+                    theta *= randomState.lognormal(0, 0.02)
+                    rho *= randomState.lognormal(0, 0.02)
+                    lambdas = lambdas * randomState.lognormal(0, 0.1, nIntervals)
+                timePoints = 0.1 * numpy.exp(intervalIndex / (nIntervals - 1) * numpy.log(1 + 10 * maxT)) - 0.1
+                intervalWeights = numpy.diff(numpy.append(timePoints, 2 * maxT)) / lambdas
+                piPoints = intervalWeights / intervalWeights.sum()
+                logLikelihood = -3e6 * (1 + 1.0 / (iteration + 1)) if iteration else 0
+                psmcFile.write("RD\t%d\nLK\t%f\nQD\t%f -> %f\nRI\t%.10f\nTR\t%f\t%f\nMT\t%f\n"
+                               "MM\tC_pi: %f, n_recomb: %f\n"
+                               % (iteration, logLikelihood, logLikelihood / 60, logLikelihood / 140,
+                                  0.04 / (iteration + 1) if iteration else float("inf"),
+                                  theta, rho, maxT, 1 + 0.04 * randomState.random_sample(),
+                                  1e5 * randomState.lognormal(0, 0.1)))
+                psmcFile.write("".join(
+                    "RS\t%d\t%f\t%f\t%f\t%f\t%f\n" % rsColumns for rsColumns in zip(
+                        intervalIndex.tolist(), timePoints.tolist(), lambdas.tolist(), (piPoints * 1e6).tolist(),
+                        piPoints.tolist(), (piPoints * 0.5).tolist())))
+                psmcFile.write("PA\t%d*1 %.9f %.9f %.9f %s\n//\n" % (
+                    nIntervals, theta, rho, maxT, " ".join("%.9f" % lambda_k for lambda_k in lambdas)))
+    return pathToPsmcFile
+
+
+def write_synthetic_options(pathToOptionsFile, pathToPsmcFile, nRows):
+    # a parameter file in the readPsmcOptions format, every other row without a colour
+    with open(pathToOptionsFile, 'w') as optionsFile:
+        optionsFile.write("#PathToPSMCfile GenerationTime MutationRate BinSize SampleName Color\n")
+        for i_row in range(nRows):
+            optionsFile.write('"%s" 25 2.5e-8 100 "sample%d"%s\n'
+                              % (pathToPsmcFile, i_row, ' "C%d"' % (i_row % 10) if i_row % 2 else ""))
+    return pathToOptionsFile
+
+
+def write_bgzip(pathToFile, pathToBgzip):
+    # bgzip without htslib: independent gzip members of at most 65280 bytes of text, each with the "BC"
+    # extra subfield giving its size, then the empty end-of-file block
+    with open(pathToFile, 'rb') as textFile, open(pathToBgzip, 'wb') as bgzipFile:
+        for blockText in iter(lambda: textFile.read(65280), b""):
+            deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            blockData = deflater.compress(blockText) + deflater.flush()
+            bgzipFile.write(b"\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0"
+                            + struct.pack("<H", len(blockData) + 25) + blockData
+                            + struct.pack("<II", zlib.crc32(blockText), len(blockText)))
+        bgzipFile.write(bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000"))
+    return pathToBgzip
+
+
+def make_bootstrap_file(pathToPsmcFile, nCopies, outputDirectory):
+    # a large "combined" file made of copies of a shipped one, like the output of cat'ing bootstrap runs
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        psmcText = psmcFile.read()
+    pathToBigFile = os.path.join(outputDirectory, "bench_%dx_%s" % (nCopies, os.path.basename(pathToPsmcFile)))
+    with open(pathToBigFile, 'wb') as bigFile:
+        for _ in range(nCopies):
+            bigFile.write(psmcText)
+    return pathToBigFile
+
+
+def python_rs_block(iterationBlock):
+    # per-line float() conversion and list scaling, as parse_psmc_output used to do it
+    timePoints, lambdaPoints = [], []
+    estimatedTheta = 0
+    for line in iterationBlock.decode().splitlines():
+        if line[:2] == "RS":
+            timePoints.append(float(line.split('\t')[2]))
+            lambdaPoints.append(float(line.split('\t')[3]))
+        elif line[:2] == "PA":
+            estimatedTheta = float(line.split()[2])
+    n0 = estimatedTheta/(4*2.5e-8)/100
+    return [25 * 2 * n0 * time_k for time_k in timePoints], [n0 * lambda_k for lambda_k in lambdaPoints]
+
+
+def numpy_rs_blocks(iterationBlocks):
+    estimatedThetas, timePoints, lambdaPoints = PlotPSMC._read_iteration_blocks(iterationBlocks)
+    return PlotPSMC._scale_psmc_points(timePoints, lambdaPoints, estimatedThetas[:, None],
+                                       ("", 25, 2.5e-8, 100), True)
+
+
+def best_of(statement, repeat):
+    return min(timeit.repeat(statement, number=1, repeat=repeat))
+
+
+def bench_parse(pathToPsmcFile, repeat):
+    psmcOptions = [(pathToPsmcFile, 25, 2.5e-8, 100, "bench", "black")]
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        psmcText = psmcFile.read()
+    iterationBlocks = [psmcText[start:end] for start, end in PlotPSMC._find_last_iteration_blocks(psmcText)]
+    archiveOptions = [(PlotPSMC.convert_psmc_to_archive(
+        pathToPsmcFile, os.path.splitext(pathToPsmcFile)[0] + ".psmcarc"),) + psmcOptions[0][1:]]
+    with open(pathToPsmcFile, 'rb') as psmcFile, gzip.open(pathToPsmcFile + ".gz", 'wb') as gzipFile:
+        shutil.copyfileobj(psmcFile, gzipFile)
+    gzipOptions = [(pathToPsmcFile + ".gz",) + psmcOptions[0][1:]]
+    bgzipOptions = [(write_bgzip(pathToPsmcFile, pathToPsmcFile + ".bgz"),) + psmcOptions[0][1:]]
+
+    rawIterations = PlotPSMC.read_psmc_raw(pathToPsmcFile, useCache=False)
+
+    PlotPSMC.parseCacheDirectory = os.path.join(os.path.dirname(pathToPsmcFile), "cache")
+    try:
+        PlotPSMC.parse_psmc_output(psmcOptions, True)
+        return len(iterationBlocks), [
+            ("parse, line scan", best_of(
+                lambda: PlotPSMC.parse_psmc_output(psmcOptions, True, seekLastIteration=False), repeat)),
+            ("parse, seek last round", best_of(
+                lambda: PlotPSMC.parse_psmc_output(psmcOptions, True, useCache=False), repeat)),
+            ("parse, warm cache", best_of(
+                lambda: (PlotPSMC._contentDigests.clear(), PlotPSMC.parse_psmc_output(psmcOptions, True)), repeat)),
+            ("parse, warm cache+digest", best_of(
+                lambda: PlotPSMC.parse_psmc_output(psmcOptions, True), repeat)),
+            ("parse, archive", best_of(
+                lambda: PlotPSMC.parse_psmc_output(archiveOptions, True), repeat)),
+            ("parse, gzip", best_of(
+                lambda: PlotPSMC.parse_psmc_output(gzipOptions, True, useCache=False), repeat)),
+            ("parse, bgzip", best_of(
+                lambda: PlotPSMC.parse_psmc_output(bgzipOptions, True, useCache=False), repeat)),
+            ("round index, build", best_of(
+                lambda: PlotPSMC.build_psmc_index(pathToPsmcFile), repeat)),
+            ("one round, indexed", best_of(
+                lambda: PlotPSMC.read_psmc_round(pathToPsmcFile, len(iterationBlocks) // 2, 1), repeat)),
+            ("rescale, 10x10 grid", best_of(
+                lambda: PlotPSMC.rescale_psmc_grid(rawIterations, True, numpy.linspace(15, 30, 10),
+                                                   numpy.geomspace(0.5e-8, 3e-8, 10), [100]), repeat)),
+            ("RS decode+scale, python", best_of(
+                lambda: [python_rs_block(block) for block in iterationBlocks], repeat)),
+            ("RS decode+scale, numpy", best_of(
+                lambda: numpy_rs_blocks(iterationBlocks), repeat)),
+        ]
+    finally:
+        # the other benchmarks parse without the cache
+        PlotPSMC.parseCacheDirectory = None
+
+
+def bench_pool(pathToPsmcFile, nSamples, maxWorkers, repeat):
+    # nSamples links to the same input, parsed with 1, 2, 4, ... worker processes and threads. parse_psmc_output
+    # reads a file listed several times only once, so every sample needs a path of its own
+    sampleDirectory = os.path.join(os.path.dirname(pathToPsmcFile), "pool_samples")
+    os.makedirs(sampleDirectory, exist_ok=True)
+    psmcOptions = []
+    for i in range(nSamples):
+        pathToSample = os.path.join(sampleDirectory, "bench%d.psmc" % i)
+        if not os.path.lexists(pathToSample):
+            try:
+                os.symlink(os.path.abspath(pathToPsmcFile), pathToSample)
+            except OSError:  # no symlinks, e.g. on Windows without the privilege
+                shutil.copyfile(pathToPsmcFile, pathToSample)
+        psmcOptions.append((pathToSample, 25, 2.5e-8, 100, "bench%d" % i, "black"))
+
+    results = []
+    nWorkers = 1
+    while nWorkers <= maxWorkers:
+        for useThreads in (False, True):
+            if nWorkers == 1 and useThreads:
+                continue
+            results.append(("%d %s" % (nWorkers, "threads" if useThreads else "processes"), best_of(
+                lambda: PlotPSMC.parse_psmc_output(psmcOptions, True, useCache=False,
+                                                   nWorkers=nWorkers, useThreads=useThreads), repeat)))
+        nWorkers *= 2
+    return results
+
+
+def bench_draw(pathToPsmcFile, nSamples, repeat):
+    # full plotPsmc runs (parse, draw and savefig) with both ways of drawing the bootstrap replicates
+    psmcOptions = [(pathToPsmcFile, 25, 2.5e-8, 100, "bench%d" % i, "C%d" % i) for i in range(nSamples)]
+    plotDirectory = os.path.join(os.path.dirname(pathToPsmcFile), "Plots")
+
+    sampleReplicates = PlotPSMC.parse_psmc_output(psmcOptions[:1], True)[0]
+    _, logSizes = PlotPSMC.project_psmc_curves(sampleReplicates * 10)
+    curveDistances = PlotPSMC.curve_distance_matrix(logSizes)
+    return [("plot, %s" % bootstrapStyle, best_of(
+        lambda: PlotPSMC.plotPsmc(psmcOptions, True, plotDirectory=plotDirectory,
+                                  bootstrapStyle=bootstrapStyle), repeat))
+            for bootstrapStyle in ("steps", "collection", "summary", "density")] + [
+        ("summary of %d replicates" % (10 * len(sampleReplicates)), best_of(
+            lambda: PlotPSMC.summarize_bootstraps(sampleReplicates * 10), repeat)),
+        ("density of %d replicates" % (10 * len(sampleReplicates)), best_of(
+            lambda: PlotPSMC.bootstrap_density(sampleReplicates * 10), repeat)),
+        ("distances of %d curves" % len(curveDistances), best_of(
+            lambda: PlotPSMC.curve_distance_matrix(PlotPSMC.project_psmc_curves(sampleReplicates * 10)[1]), repeat)),
+        ("clustering of %d curves" % len(curveDistances), best_of(
+            lambda: PlotPSMC.cluster_order(curveDistances), repeat))]
+
+
+def bench_plot_stages(pathToPsmcFile, nSamples, repeat):
+    # the stages of a plotPsmc run timed one after the other, best of repeat for each stage
+    psmcOptions = [(pathToPsmcFile, 25, 2.5e-8, 100, "bench%d" % i, "C%d" % i) for i in range(nSamples)]
+    pathToPlot = os.path.join(os.path.dirname(pathToPsmcFile), "Plots", "stages.png")
+    os.makedirs(os.path.dirname(pathToPlot), exist_ok=True)
+
+    stageTimes = {}
+
+    def timed(stageName, stage):
+        startTime = time.perf_counter()
+        stageResult = stage()
+        stageTimes.setdefault(stageName, []).append(time.perf_counter() - startTime)
+        return stageResult
+
+    for _ in range(repeat):
+        lastIterations = timed("parse", lambda: [PlotPSMC._seek_last_iterations(psmcFiles[0])
+                                                 for psmcFiles in psmcOptions])
+        timed("scale", lambda: [PlotPSMC._scale_psmc_points(timePoints, lambdaPoints,
+                                                            numpy.asarray(estimatedThetas)[:, None], psmcFiles, True)
+                                for (estimatedThetas, timePoints, lambdaPoints), psmcFiles
+                                in zip(lastIterations, psmcOptions)])
+        # parses again, parse and scale are part of building the figure
+        figure = timed("build figure", lambda: PlotPSMC.PsmcFigure(psmcOptions, True).set_options())
+        timed("draw", figure.canvas.draw)
+        timed("save png", lambda: figure.savefig(pathToPlot))
+        timed("export 4 formats, one by one", lambda: PlotPSMC.export_psmc_figure(
+            figure, os.path.splitext(pathToPlot)[0], nWorkers=1))
+        timed("export 4 formats, at once", lambda: PlotPSMC.export_psmc_figure(
+            figure, os.path.splitext(pathToPlot)[0], nWorkers=len(PlotPSMC.defaultExportFormats)))
+    return [(stageName, min(seconds)) for stageName, seconds in stageTimes.items()]
+
+
+def bench_options(pathToPsmcFile, nRows, repeat):
+    pathToOptionsFile = write_synthetic_options(
+        os.path.join(os.path.dirname(pathToPsmcFile), "bench_options.txt"), pathToPsmcFile, nRows)
+    # the rows all list the same file, which is parsed once and scaled for every row
+    sharedOptions = PlotPSMC.readPsmcOptions(pathToOptionsFile)[:100]
+    return [("readPsmcOptions, %d rows" % nRows, best_of(lambda: PlotPSMC.readPsmcOptions(pathToOptionsFile), repeat)),
+            ("parse, %d rows of one file" % len(sharedOptions), best_of(
+                lambda: PlotPSMC.parse_psmc_output(sharedOptions, True, useCache=False), repeat))]
+
+
+def bench_startup(moduleNames, repeat):
+    # time taken by the import statement of each module, best of repeat fresh interpreters (-X importtime would
+    # give the same but needs python 3.7)
+    results = []
+    for moduleName in moduleNames:
+        importTimes = []
+        for _ in range(repeat):
+            importProcess = subprocess.run(
+                [sys.executable, "-c", "import time; startTime = time.perf_counter(); import %s; "
+                                       "print(time.perf_counter() - startTime)" % moduleName],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            importTimes.append(float(importProcess.stdout.split()[-1]))
+        results.append(("import " + moduleName, min(importTimes)))
+    return results
+
+
+def check_truncated_replicate(workDirectory):
+    # a combined file whose second replicate stops after one of its first rounds (a killed bootstrap run): every
+    # reader must skip that replicate alone and return all the others, as the line by line scan does
+    pathToPsmcFile = write_synthetic_psmc(os.path.join(workDirectory, "check_full.psmc"), 5, 10, 16)
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        psmcText = psmcFile.read()
+    replicateStart = psmcText.find(b"CC\nCC\tBrief", 1)
+    nextReplicateStart = psmcText.find(b"CC\nCC\tBrief", replicateStart + 1)
+
+    checkFailures = []
+    for lastRound in (0, 3):
+        roundEnd = psmcText.find(b"\nRD\t%d\n" % (lastRound + 1), replicateStart) + 1
+        pathToTruncated = os.path.join(workDirectory, "check_truncated_rd%d.psmc" % lastRound)
+        with open(pathToTruncated, 'wb') as truncatedFile:
+            truncatedFile.write(psmcText[:roundEnd] + psmcText[nextReplicateStart:])
+        with open(pathToTruncated, 'rb') as truncatedFile, gzip.open(pathToTruncated + ".gz", 'wb') as gzipFile:
+            shutil.copyfileobj(truncatedFile, gzipFile)
+
+        psmcFiles = (pathToTruncated, 25, 2.5e-8, 100, "truncated", "black")
+        gzipFiles = (pathToTruncated + ".gz",) + psmcFiles[1:]
+        expectedReplicates = PlotPSMC.parse_psmc_output([psmcFiles], True, seekLastIteration=False,
+                                                        useCache=False)[0]
+        if len(expectedReplicates) != 4:
+            checkFailures.append("cut after RD %d: the line by line scan returned %d replicates, not 4"
+                                 % (lastRound, len(expectedReplicates)))
+        for readerName, readReplicates in (
+                ("seek", PlotPSMC.parse_psmc_output([psmcFiles], True, useCache=False)[0]),
+                ("gzip stream", PlotPSMC.parse_psmc_output([gzipFiles], True, useCache=False)[0]),
+                ("replicate iterator", list(PlotPSMC.iter_psmc_replicates(psmcFiles, True)))):
+            if len(readReplicates) != len(expectedReplicates) or not all(
+                    numpy.array_equal(readTime, expectedTime) and numpy.array_equal(readSize, expectedSize)
+                    for (readTime, readSize), (expectedTime, expectedSize)
+                    in zip(readReplicates, expectedReplicates)):
+                checkFailures.append("cut after RD %d: %s returned %d replicates, the line by line scan %d"
+                                     % (lastRound, readerName, len(readReplicates), len(expectedReplicates)))
+    return checkFailures
+
+
+def check_unfinished_round(workDirectory):
+    # a file that ends inside its last round, in an RS line or in the PA line, as when psmc is still writing it
+    # or was killed: that round is dropped by the round reader and the archive, and every reader of the last
+    # rounds leaves out its replicate
+    pathToPsmcFile = write_synthetic_psmc(os.path.join(workDirectory, "check_unfinished_full.psmc"), 3, 6, 16)
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        psmcText = psmcFile.read()
+    fullRounds = PlotPSMC.read_psmc_rounds(pathToPsmcFile)
+    nRounds = numpy.count_nonzero(~numpy.isnan(fullRounds["PA_theta"]))
+    lastRs, lastPa = psmcText.rfind(b"\nRS\t") + 1, psmcText.rfind(b"\nPA\t") + 1
+
+    checkFailures = []
+    for cutName, cutAt in (("an RS line", lastRs + 8), ("the PA line", lastPa + 20)):
+        pathToUnfinished = os.path.join(workDirectory, "check_unfinished.psmc")
+        with open(pathToUnfinished, 'wb') as unfinishedFile:
+            unfinishedFile.write(psmcText[:cutAt])
+        try:
+            psmcRounds = PlotPSMC.read_psmc_rounds(pathToUnfinished)
+            pathToArchive = PlotPSMC.convert_psmc_to_archive(pathToUnfinished,
+                                                             os.path.join(workDirectory, "check_unfinished.psmcarc"))
+            readerThetas = [("seek", PlotPSMC.read_psmc_raw(pathToUnfinished, useCache=False)[0]),
+                            ("line by line scan", PlotPSMC.read_psmc_raw(pathToUnfinished, False, False)[0]),
+                            ("archive", PlotPSMC.read_psmc_raw(pathToArchive)[0])]
+        except Exception as readError:
+            checkFailures.append("cut in %s: %s: %s" % (cutName, type(readError).__name__, readError))
+            continue
+        nUnfinishedRounds = numpy.count_nonzero(~numpy.isnan(psmcRounds["PA_theta"]))
+        if nUnfinishedRounds != nRounds - 1:
+            checkFailures.append("cut in %s: read_psmc_rounds found %d rounds, not %d"
+                                 % (cutName, nUnfinishedRounds, nRounds - 1))
+        for readerName, estimatedThetas in readerThetas:
+            if not numpy.array_equal(estimatedThetas, fullRounds["PA_theta"][:-1, -1]):
+                checkFailures.append("cut in %s: %s returned %d replicates, not the 2 complete ones"
+                                     % (cutName, readerName, len(estimatedThetas)))
+    return checkFailures
+
+
+def check_follow_chunks(workDirectory, nChunks=400, seed=0):
+    # psmc writing a bootstrap file simulated by appending the synthetic file in random sized chunks, cut
+    # anywhere inside lines and rounds: polling after every chunk must return every round exactly once, with
+    # the values read_psmc_rounds finds in the whole file
+    pathToPsmcFile = write_synthetic_psmc(os.path.join(workDirectory, "check_follow_full.psmc"), 4, 12, 16)
+    with open(pathToPsmcFile, 'rb') as psmcFile:
+        psmcText = psmcFile.read()
+    psmcRounds = PlotPSMC.read_psmc_rounds(pathToPsmcFile)
+
+    randomState = numpy.random.RandomState(seed)
+    chunkEnds = numpy.sort(randomState.randint(0, len(psmcText), nChunks)).tolist() + [len(psmcText)]
+    pathToGrowingFile = os.path.join(workDirectory, "check_follow_growing.psmc")
+    polledRounds = []
+    with open(pathToGrowingFile, 'wb') as growingFile:
+        psmcFollower = PlotPSMC.PsmcFollower(pathToGrowingFile)
+        try:
+            chunkStart = 0
+            for chunkEnd in chunkEnds:
+                growingFile.write(psmcText[chunkStart:chunkEnd])
+                growingFile.flush()
+                chunkStart = chunkEnd
+                polledRounds += psmcFollower.poll()
+        finally:
+            psmcFollower.close()
+
+    checkFailures = []
+    nRounds = numpy.count_nonzero(~numpy.isnan(psmcRounds["PA_theta"]))
+    if len(polledRounds) != nRounds:
+        checkFailures.append("following: %d rounds polled, read_psmc_rounds found %d" % (len(polledRounds), nRounds))
+    for i_replicate, roundIteration, estimatedTheta, timePoints, lambdaPoints in polledRounds:
+        if not (estimatedTheta == psmcRounds["PA_theta"][i_replicate, roundIteration]
+                and numpy.array_equal(timePoints, psmcRounds["times"][i_replicate, roundIteration])
+                and numpy.array_equal(lambdaPoints, psmcRounds["lambdas"][i_replicate, roundIteration])):
+            checkFailures.append("following: replicate %d, RD %d differs from read_psmc_rounds"
+                                 % (i_replicate, roundIteration))
+    return checkFailures
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_section(sectionName, sectionResults, benchmarkResults, previousResults):
+    # prints one block of timings and adds it to benchmarkResults, with the change against previousResults
+    print(sectionName + ":")
+    for name, seconds in sectionResults:
+        benchmarkResults.append(dict(section=sectionName, name=name, seconds=seconds))
+        previousSeconds = previousResults.get((sectionName, name))
+        print("%-26s %10.2f ms%s" % (name, seconds * 1e3,
+                                     "  %+6.1f%%" % (100 * (seconds / previousSeconds - 1)) if previousSeconds else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the PlotPSMC parsing, plotting and startup stages.")
+    parser.add_argument("--psmc", default=None,
+                        help="psmc file repeated --copies times as the benchmark input, "
+                             "instead of a synthetic file")
+    parser.add_argument("--copies", type=int, default=20,
+                        help="number of times the --psmc file is repeated in the benchmark input")
+    parser.add_argument("--replicates", type=int, default=100,
+                        help="bootstrap replicates in the synthetic input, 1000 make a file of about 115 MB")
+    parser.add_argument("--iterations", type=int, default=25, help="rounds of iterations in the synthetic input")
+    parser.add_argument("--intervals", type=int, default=64, help="atomic time intervals in the synthetic input")
+    parser.add_argument("--generate", metavar="PATH",
+                        help="only write the synthetic input to PATH, for use with other tools")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--plot-samples", type=int, default=5,
+                        help="number of samples drawn in the plotting benchmark")
+    parser.add_argument("--option-rows", type=int, default=10000,
+                        help="number of rows of the parameter file read in the readPsmcOptions benchmark")
+    parser.add_argument("--samples", type=int, default=30,
+                        help="number of samples in the parallel parsing benchmark")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="largest pool size in the parallel parsing benchmark")
+    parser.add_argument("--check", action="store_true",
+                        help="only check that the fast readers return the same as the line by line scan on "
+                             "files the benchmarks do not cover, fails on the first difference")
+    parser.add_argument("--startup", action="store_true",
+                        help="only check the import time of the modules, fails past --max-import-ms")
+    parser.add_argument("--max-import-ms", type=float, default=150)
+    parser.add_argument("--json", metavar="PATH",
+                        help="also write the results, with the commit and versions they were measured on, to PATH")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="results of an earlier --json run, printed timings show the change against it")
+    args = parser.parse_args()
+
+    if args.generate:
+        write_synthetic_psmc(args.generate, args.replicates, args.iterations, args.intervals)
+        return 0
+
+    if args.check:
+        workDirectory = tempfile.mkdtemp(prefix="plotpsmc_check_")
+        try:
+            checks = (check_truncated_replicate, check_unfinished_round, check_follow_chunks)
+            checkFailures = [checkFailure for check in checks for checkFailure in check(workDirectory)]
+        finally:
+            shutil.rmtree(workDirectory)
+        print("\n".join(checkFailures) or "all checks passed")
+        return 1 if checkFailures else 0
+
+    previousResults = {}
+    if args.compare:
+        with open(args.compare) as previousFile:
+            previousResults = {(result["section"], result["name"]): result["seconds"]
+                               for result in json.load(previousFile)["results"]}
+
+    benchmarkResults = []
+    startupResults = bench_startup(["PlotPSMC", "PlotPSMC_GUI"], args.repeat)
+    print_section("startup", startupResults, benchmarkResults, previousResults)
+    slowImports = [name for name, seconds in startupResults if seconds * 1e3 > args.max_import_ms]
+    if slowImports:
+        print("import time regression (> %g ms): %s" % (args.max_import_ms, ", ".join(slowImports)))
+        if args.startup:
+            return 1
+
+    benchmarkInput = {}
+    if not args.startup:
+        workDirectory = tempfile.mkdtemp(prefix="plotpsmc_bench_")
+        try:
+            if args.psmc:
+                pathToBigFile = make_bootstrap_file(args.psmc, args.copies, workDirectory)
+                benchmarkInput.update(psmc=os.path.basename(args.psmc), copies=args.copies)
+            else:
+                pathToBigFile = write_synthetic_psmc(os.path.join(workDirectory, "bench_synthetic.psmc"),
+                                                     args.replicates, args.iterations, args.intervals)
+                benchmarkInput.update(replicates=args.replicates, iterations=args.iterations,
+                                      intervals=args.intervals)
+            nReplicates, parseResults = bench_parse(pathToBigFile, args.repeat)
+            benchmarkInput.update(bytes=os.path.getsize(pathToBigFile), lastRounds=nReplicates)
+            print("%s: %d replicates, %.1f MB" % (os.path.basename(pathToBigFile), nReplicates,
+                                                  os.path.getsize(pathToBigFile) / 1e6))
+            print_section("parse", parseResults, benchmarkResults, previousResults)
+            print_section("options", bench_options(pathToBigFile, args.option_rows, args.repeat),
+                          benchmarkResults, previousResults)
+            print_section("%d samples, plot stages" % args.plot_samples,
+                          bench_plot_stages(pathToBigFile, args.plot_samples, args.repeat),
+                          benchmarkResults, previousResults)
+            print_section("%d samples, plotting" % args.plot_samples,
+                          bench_draw(pathToBigFile, args.plot_samples, args.repeat),
+                          benchmarkResults, previousResults)
+            print_section("%d samples, parallel parsing" % args.samples,
+                          bench_pool(pathToBigFile, args.samples, args.workers, args.repeat),
+                          benchmarkResults, previousResults)
+        finally:
+            shutil.rmtree(workDirectory)
+
+    if args.json:
+        import matplotlib
+        with open(args.json, 'w') as jsonFile:
+            json.dump(dict(commit=git_commit(),
+                           date=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                           python=platform.python_version(),
+                           numpy=numpy.__version__,
+                           matplotlib=matplotlib.__version__,
+                           machine=platform.platform(),
+                           cpus=os.cpu_count(),
+                           repeat=args.repeat,
+                           input=benchmarkInput,
+                           results=benchmarkResults), jsonFile, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+import matplotlib
+matplotlib.use("Agg")  # headless, must happen before anything imports pyplot
+
+import argparse
+import collections
+import hashlib
+import http.server
+import io
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+import urllib.parse
+
+import PlotPSMC
+
+
+# options of a plot request besides the samples, with their defaults (those of plotPsmc)
+FIGURE_OPTIONS = dict(yAsEffectiveSize=True, bootstrapStyle="collection", summaryPercentiles=(2.5, 97.5))
+AXIS_OPTIONS = dict(xmin=0, xmax=0, ymin=0, ymax=0, transparency=0.1, isXLogScale=True, isYLogScale=False,
+                    showLGM=False)
+IMAGE_TYPES = dict(png="image/png", svg="image/svg+xml", pdf="application/pdf")
+
+
+class _PendingRender:
+    # a render that identical requests arriving meanwhile wait for instead of rendering it again
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.image = None
+        self.error = None
+
+
+class PlotRenderer:
+    # Renders plots for a long-running process. The figures of the last maxFigures sample lists are kept with
+    # their artists, so that a request that only changes axis options does not read any file again, and the
+    # rendered images are kept in a least recently used cache of up to maxCacheBytes, keyed by the samples,
+    # the size and modification time of their files, the options and the format. Requests for an image that
+    # is being rendered wait for it. Figures are drawn one at a time, matplotlib is not thread-safe.
+
+    def __init__(self, maxCacheBytes=256 * 2**20, maxFigures=8):
+        self.maxCacheBytes = maxCacheBytes
+        self.maxFigures = maxFigures
+        self._images = collections.OrderedDict()  # cache key -> image bytes
+        self._cacheBytes = 0
+        self._figures = collections.OrderedDict()  # figure key -> PsmcFigure
+        self._pending = {}  # cache key -> _PendingRender
+        self._parameterFiles = {}  # (path, size, mtime) -> readPsmcOptions
+        self._lock = threading.Lock()
+        self._renderLock = threading.Lock()
+        self.counts = collections.Counter()
+
+    @staticmethod
+    def plot_options(requestOptions):
+        # the figure and axis options of a request, with defaults, rejecting unknown ones
+        unknownOptions = set(requestOptions) - set(FIGURE_OPTIONS) - set(AXIS_OPTIONS)
+        if unknownOptions:
+            raise ValueError("unknown plot options: %s" % ", ".join(sorted(unknownOptions)))
+        figureOptions = {optionName: requestOptions.get(optionName, defaultValue)
+                         for optionName, defaultValue in FIGURE_OPTIONS.items()}
+        figureOptions["yAsEffectiveSize"] = bool(figureOptions["yAsEffectiveSize"])
+        figureOptions["summaryPercentiles"] = tuple(map(float, figureOptions["summaryPercentiles"]))
+        axisOptions = {optionName: (bool if isinstance(defaultValue, bool) else float)(
+                           requestOptions.get(optionName, defaultValue))
+                       for optionName, defaultValue in AXIS_OPTIONS.items()}
+        return figureOptions, axisOptions
+
+    @staticmethod
+    def query_options(queryValues):
+        # the options of a GET request, whose parameters are all strings: true/false, numbers and
+        # comma-separated percentiles
+        requestOptions = {}
+        for optionName, optionValue in queryValues.items():
+            defaultValue = AXIS_OPTIONS.get(optionName, FIGURE_OPTIONS.get(optionName))
+            if isinstance(defaultValue, bool):
+                requestOptions[optionName] = optionValue.lower() in ("1", "true", "yes")
+            elif isinstance(defaultValue, tuple):
+                requestOptions[optionName] = optionValue.split(",")
+            else:
+                requestOptions[optionName] = optionValue
+        return requestOptions
+
+    def read_parameter_file(self, pathToOptionsFile):
+        # readPsmcOptions, kept until the file changes, so that the random colours of rows without one (and so
+        # the cache keys) stay the same from one request to the next
+        fileStat = os.stat(pathToOptionsFile)
+        fileKey = (os.path.abspath(pathToOptionsFile), fileStat.st_size, fileStat.st_mtime_ns)
+        with self._lock:
+            listOfOpt = self._parameterFiles.get(fileKey)
+        if listOfOpt is None:
+            listOfOpt = PlotPSMC.readPsmcOptions(pathToOptionsFile)
+            with self._lock:
+                listOfOpt = self._parameterFiles.setdefault(fileKey, listOfOpt)
+        return listOfOpt
+
+    def render(self, listOfOpt, requestOptions, imageFormat="png", dpi=None):
+        # Returns (image bytes, "hit", "miss" or "coalesced")
+
+        if imageFormat not in IMAGE_TYPES:
+            raise ValueError("unknown format %r, expected one of %s" % (imageFormat, ", ".join(IMAGE_TYPES)))
+        # rows given as JSON: numbers may be ints and colours lists
+        listOfOpt = [(str(psmcFiles[0]),) + tuple(map(float, psmcFiles[1:4])) + (str(psmcFiles[4]),)
+                     + tuple(tuple(optionValue) if isinstance(optionValue, list) else optionValue
+                             for optionValue in psmcFiles[5:6])
+                     for psmcFiles in listOfOpt]
+        figureOptions, axisOptions = self.plot_options(requestOptions)
+        figureKey = (PlotPSMC.PsmcFigure.sample_key(listOfOpt, **figureOptions),
+                     PlotPSMC.psmc_file_fingerprints(listOfOpt))
+        cacheKey = hashlib.sha256(repr((figureKey, sorted(axisOptions.items()), imageFormat, dpi)).encode()).digest()
+
+        with self._lock:
+            if cacheKey in self._images:
+                self._images.move_to_end(cacheKey)
+                self.counts["hit"] += 1
+                return self._images[cacheKey], "hit"
+            pendingRender = self._pending.get(cacheKey)
+            isOwner = pendingRender is None
+            if isOwner:
+                pendingRender = self._pending[cacheKey] = _PendingRender()
+                self.counts["miss"] += 1
+            else:
+                self.counts["coalesced"] += 1
+
+        if not isOwner:
+            pendingRender.done.wait()
+            if pendingRender.error is not None:
+                raise pendingRender.error
+            return pendingRender.image, "coalesced"
+
+        try:
+            pendingRender.image = self._render(figureKey, listOfOpt, figureOptions, axisOptions, imageFormat, dpi)
+        except Exception as renderError:
+            pendingRender.error = renderError
+            raise
+        finally:
+            with self._lock:
+                del self._pending[cacheKey]
+                if pendingRender.image is not None:
+                    self._store(cacheKey, pendingRender.image)
+            pendingRender.done.set()
+        return pendingRender.image, "miss"
+
+    def _render(self, figureKey, listOfOpt, figureOptions, axisOptions, imageFormat, dpi):
+
+        with self._renderLock:
+            psmcFigure = self._figures.pop(figureKey, None)
+            if psmcFigure is None:
+                psmcFigure = PlotPSMC.PsmcFigure(listOfOpt, **figureOptions)
+            self._figures[figureKey] = psmcFigure
+            while len(self._figures) > self.maxFigures:
+                self._figures.popitem(last=False)
+
+            imageBuffer = io.BytesIO()
+            saveOptions = dict(format=imageFormat) if dpi is None else dict(format=imageFormat, dpi=dpi)
+            psmcFigure.set_options(**axisOptions).savefig(imageBuffer, **saveOptions)
+            return imageBuffer.getvalue()
+
+    def _store(self, cacheKey, image):
+        # called with self._lock held
+        self._images[cacheKey] = image
+        self._cacheBytes += len(image)
+        while self._cacheBytes > self.maxCacheBytes and self._images:
+            _, evictedImage = self._images.popitem(last=False)
+            self._cacheBytes -= len(evictedImage)
+
+    def status(self):
+        with self._lock:
+            return dict(self.counts, cachedImages=len(self._images), cacheBytes=self._cacheBytes,
+                        figures=len(self._figures), rendering=len(self._pending))
+
+    def warm_up(self):
+        # draws an empty figure once, so that matplotlib, the backends and the font cache are loaded before the
+        # first request
+        for imageFormat in IMAGE_TYPES:
+            emptyFigure = PlotPSMC.mfigure.Figure()
+            PlotPSMC.backend_agg.FigureCanvasAgg(emptyFigure)
+            emptyFigure.add_subplot(111).set_title("PSMC")
+            emptyFigure.savefig(io.BytesIO(), format=imageFormat)
+
+
+class PlotRequestHandler(http.server.BaseHTTPRequestHandler):
+    # GET  /plot?parameterFile=samples.csv&format=png&xmax=1e7...  one image, axis and figure options as parameters
+    # POST /plot  {"samples": [[path, g, mu, bin, name, color], ...] or "parameterFile": path,
+    #              "options": {...}, "format": "png", "dpi": 150}
+    # GET  /status  cache statistics as JSON
+    # The image comes back with an X-Plot-Cache header: hit, miss or coalesced.
+
+    server_version = "PlotPSMC"
+
+    def do_GET(self):
+        requestUrl = urllib.parse.urlsplit(self.path)
+        if requestUrl.path == "/status":
+            self.send_body(200, "application/json", json.dumps(self.server.renderer.status()).encode())
+        elif requestUrl.path == "/plot":
+            queryValues = dict(urllib.parse.parse_qsl(requestUrl.query))
+            self.send_plot(dict(parameterFile=queryValues.pop("parameterFile", None),
+                                format=queryValues.pop("format", "png"), dpi=queryValues.pop("dpi", None),
+                                options=PlotRenderer.query_options(queryValues)))
+        else:
+            self.send_body(404, "text/plain", b"not found, see /plot and /status\n")
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != "/plot":
+            self.send_body(404, "text/plain", b"not found, see /plot and /status\n")
+            return
+        try:
+            plotRequest = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as requestError:
+            self.send_body(400, "text/plain", ("invalid JSON: %s\n" % requestError).encode())
+            return
+        self.send_plot(plotRequest)
+
+    def send_plot(self, plotRequest):
+
+        startTime = time.perf_counter()
+        try:
+            if plotRequest.get("parameterFile"):
+                listOfOpt = self.server.renderer.read_parameter_file(plotRequest["parameterFile"])
+            else:
+                listOfOpt = plotRequest.get("samples") or []
+            if not listOfOpt:
+                raise ValueError("the request has neither samples nor a parameterFile")
+            dpi = plotRequest.get("dpi")
+            imageFormat = plotRequest.get("format", "png")
+            plotImage, cacheState = self.server.renderer.render(listOfOpt, plotRequest.get("options") or {},
+                                                                imageFormat, float(dpi) if dpi else None)
+        except (OSError, ValueError, TypeError, IndexError) as requestError:
+            self.send_body(400, "text/plain", ("%s\n" % requestError).encode())
+            return
+        except Exception as renderError:
+            self.send_body(500, "text/plain", ("%s: %s\n" % (type(renderError).__name__, renderError)).encode())
+            return
+        self.send_body(200, IMAGE_TYPES[imageFormat], plotImage,
+                       {"X-Plot-Cache": cacheState, "X-Plot-Seconds": "%.3f" % (time.perf_counter() - startTime)})
+
+    def send_body(self, statusCode, contentType, responseBody, extraHeaders=None):
+        self.send_response(statusCode)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(responseBody)))
+        for headerName, headerValue in (extraHeaders or {}).items():
+            self.send_header(headerName, headerValue)
+        self.end_headers()
+        self.wfile.write(responseBody)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix socket"
+
+    def log_message(self, messageFormat, *messageArguments):
+        if not self.server.quiet:
+            super().log_message(messageFormat, *messageArguments)
+
+
+class PlotHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, serverAddress, renderer, quiet=False):
+        hostAddress = serverAddress[0]
+        if hostAddress != "localhost" and not ipaddress.ip_address(hostAddress).is_loopback:
+            raise ValueError("the plot server only listens on localhost, not on %s" % hostAddress)
+        if ":" in hostAddress:
+            self.address_family = socket.AF_INET6
+        self.renderer = renderer
+        self.quiet = quiet
+        super().__init__(serverAddress, PlotRequestHandler)
+
+
+def _is_socket(pathToSocket):
+    try:
+        return stat.S_ISSOCK(os.lstat(pathToSocket).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+class PlotUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, pathToSocket, renderer, quiet=False):
+        if _is_socket(pathToSocket):
+            os.remove(pathToSocket)  # left over by a server that was killed
+        elif os.path.lexists(pathToSocket):
+            raise ValueError("%s exists and is not a socket, the plot server does not replace it" % pathToSocket)
+        self.renderer = renderer
+        self.quiet = quiet
+        super().__init__(pathToSocket, PlotRequestHandler)
+
+
+def parse_arguments(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Serve PSMC plots from a long-running local process that keeps the parsed samples and "
+                    "rendered images in memory.")
+    parser.add_argument("--host", default="127.0.0.1", help="loopback address to listen on")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", metavar="PATH", default=None,
+                        help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--cache-mb", type=float, default=256, help="memory for rendered images")
+    parser.add_argument("--figures", type=int, default=8, help="sample lists whose figures are kept")
+    parser.add_argument("--quiet", action="store_true", help="do not log every request")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    args = parse_arguments(argv)
+    renderer = PlotRenderer(int(args.cache_mb * 2**20), args.figures)
+    renderer.warm_up()
+    try:
+        if args.socket:
+            plotServer = PlotUnixServer(args.socket, renderer, args.quiet)
+        else:
+            plotServer = PlotHTTPServer((args.host, args.port), renderer, args.quiet)
+    except ValueError as addressError:
+        print(addressError, file=sys.stderr)
+        return 1
+    if args.socket:
+        print("Serving PSMC plots on %s" % args.socket)
+    else:
+        print("Serving PSMC plots on http://%s:%d/plot" % (args.host, plotServer.server_address[1]))
+    try:
+        plotServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        plotServer.server_close()
+        if args.socket and _is_socket(args.socket):
+            os.remove(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())